@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+
+''' Timing benchmarks for operations on large graphs.
+
+Run with the names of the benchmarks to run (or none to run all of
+them):
+
+    $ ./Benchmark.py save draw
+'''
+
+import os
+import sys
+import json
+import random
+import resource
+import tempfile
+from time import time
+from multiprocessing import Process, Pipe
+
+from Model import *
+from Spatial import *
+from Search import *
+from Undo import *
+
+def randomGraph(numStates, degree=3, seed=0):
+    ''' Builds a graph with numStates states, each having up to
+    degree transitions to randomly chosen states '''
+    rng = random.Random(seed)
+    graph = Graph()
+    for i in xrange(numStates):
+        graph.addState('State %d' % i, rng.randint(1, 2000),
+                       rng.randint(1, 2000))
+    for i in xrange(numStates):
+        start = graph.getState(i)
+        for c in xrange(degree):
+            end = graph.getState(rng.randrange(numStates))
+            graph.addTransition(start, end, 'Command %d' % c)
+    graph.setEnd(numStates - 1, True)
+    return graph
+
+def localGraph(numStates, degree=3, seed=0):
+    ''' Builds a graph laid out on a grid, with transitions only
+    between nearby states (closer to how real games are drawn) '''
+    rng = random.Random(seed)
+    width = int(numStates ** 0.5) + 1
+    graph = Graph()
+    for i in xrange(numStates):
+        graph.addState('State %d' % i, 50 * (i % width) + 25,
+                       50 * (i // width) + 25)
+    for i in xrange(numStates):
+        start = graph.getState(i)
+        for c in xrange(degree):
+            j = i + rng.randint(-2, 2) + width * rng.randint(-2, 2)
+            end = graph.getState(min(max(j, 0), numStates - 1))
+            graph.addTransition(start, end, 'Command %d' % c)
+    graph.setEnd(numStates - 1, True)
+    return graph
+
+def randomSerialized(numStates, degree=3, seed=0):
+    ''' Generates the serialized form of a random graph one state at a
+    time, without building State objects '''
+    rng = random.Random(seed)
+    for i in xrange(numStates):
+        transitions = dict(('Command %d' % c, rng.randrange(numStates))
+                           for c in xrange(degree))
+        yield {'state': 'State %d' % i,
+               'x': rng.randint(1, 2000), 'y': rng.randint(1, 2000),
+               'end': i == numStates - 1,
+               'transitions': transitions}
+
+def timeIt(function, *args):
+    ''' Returns the number of seconds a call to function takes '''
+    start = time()
+    function(*args)
+    return time() - start
+
+def peakMemory(function, *args):
+    ''' Runs function in a child process and returns how much its peak
+    memory use grew, in megabytes '''
+    def child(conn):
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        function(*args)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        conn.send((after - before) / 1024.0)
+    parent, conn = Pipe()
+    process = Process(target=child, args=(conn,))
+    process.start()
+    grown = parent.recv()
+    process.join()
+    return grown
+
+def report(name, sizes, function):
+    ''' Times function on graphs of the given sizes and prints the
+    time per state, which should stay flat if the cost is linear '''
+    print name
+    for n in sizes:
+        graph = randomGraph(n)
+        seconds = function(graph)
+        print '  %8d states: %8.3fs  (%6.2fus/state)' % (
+            n, seconds, 1e6 * seconds / n)
+
+# ----------------------------------
+# Benchmarks
+# ----------------------------------
+
+def benchSave(sizes):
+    report('Serializing the graph', sizes,
+           lambda graph: timeIt(graph.toSerializable))
+
+def benchRemove(sizes):
+    def remove(graph):
+        rng = random.Random(0)
+        start = time()
+        for _ in xrange(100):
+            graph.removeState(rng.randrange(1, graph.numStates()))
+        return time() - start
+    report('Removing 100 states', sizes, remove)
+
+def benchCheck(sizes):
+    def check(graph):
+        start = time()
+        graph.getUnreachable()
+        graph.getInescapable()
+        return time() - start
+    report('Finding unreachable and inescapable states', sizes, check)
+
+def randomEdit(graph, rng):
+    ''' Makes a random edit to the graph '''
+    n = graph.numStates()
+    choice = rng.randrange(6)
+    if choice == 0:
+        graph.addState()
+    elif choice == 1 and n > 1:
+        graph.removeState(rng.randrange(n))
+    elif choice == 2:
+        i = rng.randrange(n)
+        graph.setEnd(i, not graph.getState(i).end)
+    elif choice == 3:
+        i = rng.randrange(n)
+        commands = graph.getState(i).transitions.keys()
+        if commands:
+            graph.removeTransition(i, rng.choice(commands))
+    else:
+        start = graph.getState(rng.randrange(n))
+        end = graph.getState(rng.randrange(n))
+        graph.addTransition(start, end, 'Command %d' % rng.randrange(5))
+
+def benchAnalysis(sizes):
+    ''' Compares keeping the analysis up to date against searching
+    from scratch after every edit (Tests.py checks that both agree) '''
+    def analyze(graph):
+        rng = random.Random(0)
+        incremental = scratch = 0
+        for _ in xrange(200):
+            # The analysis is kept up to date during the edit itself
+            start = time()
+            randomEdit(graph, rng)
+            graph.analysis.getReachable()
+            graph.analysis.getEscapable()
+            incremental += time() - start
+            start = time()
+            graph.findReachable()
+            graph.findEscapable()
+            scratch += time() - start
+        print '  incremental %.3fs, from scratch %.3fs' % (
+            incremental, scratch)
+        return incremental
+    report('Analysis after 200 random edits', sizes, analyze)
+
+def benchCompact(sizes):
+    from Compact import compactSerialized
+    print 'Compact graph with 1M transitions'
+    start = time()
+    graph = compactSerialized(randomSerialized(1000000 / 3))
+    print '  built in %.3fs' % (time() - start)
+    print '  checked in %.3fs' % timeIt(checkGraph, graph)
+    print '  arrays use %.1fMB' % (graph.sizeInBytes() / 1e6)
+
+def benchMinimize(sizes):
+    def minimize(graph):
+        start = time()
+        classes = graph.getEquivalentStates()
+        seconds = time() - start
+        print '  %d classes' % len(classes)
+        return seconds
+    report('Finding equivalent states', sizes + [100000], minimize)
+
+def benchLoad(sizes):
+    def loadWhole(filename):
+        with open(filename) as inf:
+            return Graph(serialized=json.load(inf))
+    print 'Loading a file with 100000 states'
+    (fd, filename) = tempfile.mkstemp('.game')
+    try:
+        with os.fdopen(fd, 'w') as outf:
+            json.dump(list(randomSerialized(100000)), outf, indent=4)
+        for (name, load) in [('json.load', loadWhole),
+                             ('streaming', loadGraph)]:
+            print '  %-10s %.3fs, peak memory grew %.1fMB' % (
+                name, timeIt(load, filename), peakMemory(load, filename))
+    finally:
+        os.remove(filename)
+
+def benchBinary(sizes):
+    from Binary import saveBinary, loadBinary
+    from Compact import loadCompact
+    print 'Opening a file with 100000 states'
+    graph = Graph(serialized=randomSerialized(100000))
+    (fd, jsonFile) = tempfile.mkstemp('.game')
+    os.close(fd)
+    (fd, binaryFile) = tempfile.mkstemp('.bgame')
+    os.close(fd)
+    try:
+        saveGraph(graph, jsonFile)
+        saveBinary(graph, binaryFile)
+        print '  JSON    %.3fs' % timeIt(loadCompact, jsonFile)
+        print '  binary  %.3fs' % timeIt(loadBinary, binaryFile)
+        start = time()
+        binary = loadBinary(binaryFile)
+        binary.getText(50000)
+        print '  binary, reading one state\'s text %.3fs' % (time() - start)
+        # Compare as JSON text, where 17 and 17.0 differ
+        assert (json.dumps(binary.toSerializable()) ==
+                json.dumps(graph.toSerializable()))
+    finally:
+        os.remove(jsonFile)
+        os.remove(binaryFile)
+
+def benchMemory(sizes):
+    print 'Memory used by loaded graphs'
+    for n in [100000, 1000000]:
+        grown = peakMemory(Graph, randomSerialized(n))
+        print '  %8d states: %7.1fMB  (%4d bytes/state)' % (
+            n, grown, grown * 1e6 / n)
+
+def benchSpatial(sizes):
+    print 'Finding nodes and transitions (1000 queries)'
+    for n in sizes:
+        graph = localGraph(n)
+        index = GraphIndex(graph)
+        rng = random.Random(0)
+        size = 50 * int(n ** 0.5)
+        points = [(rng.uniform(0, size), rng.uniform(0, size))
+                  for _ in xrange(1000)]
+        clicks = timeIt(lambda: [index.nodeAt(x, y) for (x, y) in points])
+        redraws = timeIt(lambda: [index.edgesIn((x, y, x + 200, y + 200))
+                                  for (x, y) in points])
+        print '  %8d states: clicks %.3fs, 200x200 areas %.3fs' % (
+            n, clicks, redraws)
+
+def benchSearch(sizes):
+    print 'Finding states by text (each query: word start, part of a'
+    print 'word, command uses; then scanning every state)'
+    words = ['castle', 'dragon', 'forest', 'door', 'sword', 'river',
+             'tower', 'guard', 'treasure', 'bridge', 'cave', 'king']
+    for n in sizes:
+        graph = localGraph(n)
+        rng = random.Random(0)
+        for i in xrange(n):
+            text = [rng.choice(words) + str(rng.randrange(n))
+                    for _ in xrange(8)]
+            graph.setText(i, ' '.join(text))
+        # A command only a few states use
+        for _ in xrange(20):
+            graph.addTransition(graph.getState(rng.randrange(n)),
+                                graph.getState(rng.randrange(n)), 'dig')
+        start = time()
+        index = SearchIndex(graph)
+        build = time() - start
+        queries = [rng.choice(words) + str(rng.randrange(n))
+                   for _ in xrange(1000)]
+        prefix = timeIt(lambda: [index.find(q[:-1]) for q in queries])
+        part = timeIt(lambda: [index.find(q[2:]) for q in queries])
+        uses = timeIt(lambda: [index.commandUses('dig')
+                               for _ in xrange(1000)])
+        scan = timeIt(lambda: [[st for st in graph.states
+                                if q[2:] in st.text.lower()]
+                               for q in queries[:10]])
+        print '  %8d states: built in %.3fs; %.3fms %.3fms %.3fms; ' \
+              'scan %.3fms' % (n, build, prefix, part, uses, scan * 100)
+
+def benchDraw(sizes):
+    try:
+        import cairo
+        from Render import Renderer
+    except ImportError, e:
+        print 'Drawing the graph: skipped (%s)' % e
+        return
+    def draw(graph):
+        renderer = Renderer(graph, GraphIndex(graph))
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, 2000, 2000)
+        return timeIt(renderer.draw, cairo.Context(surface), 2000, 2000)
+    report('Drawing the graph', sizes, draw)
+
+def benchEdges(sizes):
+    try:
+        import cairo
+        from Render import Renderer
+    except ImportError, e:
+        print 'Drawing 10000 transitions: skipped (%s)' % e
+        return
+    graph = localGraph(3334)
+    renderer = Renderer(graph, GraphIndex(graph))
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, 3000, 3000)
+    print 'Drawing 10000 transitions'
+    first = timeIt(renderer.draw, cairo.Context(surface), 3000, 3000)
+    again = timeIt(renderer.draw, cairo.Context(surface), 3000, 3000)
+    print '  first frame %.3fs, with cached geometry %.3fs' % (first, again)
+
+def benchSelection(sizes):
+    try:
+        import cairo
+        from Controller import Controller
+        from GraphArea import GraphArea
+    except ImportError, e:
+        print 'Changing the selection: skipped (%s)' % e
+        return
+    controller = Controller()
+    controller.graph = graph = localGraph(5000)
+    controller.spatial = GraphIndex(graph)
+    area = GraphArea(controller)
+    # Draw on this thread to start with
+    area.threadedStates = graph.numStates() + 1
+    width = height = 50 * 71
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    print 'Changing the selection on a 5000 state graph'
+    first = timeIt(area.render, cairo.Context(surface), width, height)
+    print '  first frame %.3fs' % first
+    rng = random.Random(0)
+    start = time()
+    for _ in xrange(100):
+        old = area.selectionBox
+        controller.selectState(rng.randrange(graph.numStates()))
+        controller.flushChanges()
+        box = bounding_box([b for b in (old, area.selectionBox) if b])
+        cr = cairo.Context(surface)
+        cr.rectangle(*pixel_rect(box))
+        cr.clip()
+        area.render(cr, width, height)
+    print '  each change %.1fms' % ((time() - start) * 10)
+    area.threadedStates = 0
+    area.layer = None
+    blocked = timeIt(area.render, cairo.Context(surface), width, height)
+    print '  first frame drawn on the worker thread blocks for %.3fs' % (
+        blocked)
+    graph.moveState(0, 30, 30)
+    print '  snapshot for the worker thread after an edit %.4fs' % timeIt(
+        area.snapshots.snapshot)
+    area.rasterizer.stop()
+    area.rasterizer.thread.join()
+
+def benchZoom(sizes):
+    try:
+        import cairo
+        from Render import Renderer, SnapshotTracker
+    except ImportError, e:
+        print 'Drawing at each zoom: skipped (%s)' % e
+        return
+    graph = localGraph(100000)
+    renderer = Renderer(graph, GraphIndex(graph))
+    snapshot = SnapshotTracker(graph).snapshot()
+    size = 1000
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, size, size)
+    # Look at the middle of the graph
+    middle = 50 * int(100000 ** 0.5) / 2
+    print 'Drawing a 100000 state graph in a %dx%d window (on this' % (
+        size, size)
+    print 'thread, and from a snapshot as the worker thread does)'
+    for scale in (1.0, 0.3, 0.1, 0.01):
+        half = size / 2.0 / scale
+        box = (middle - half, middle - half, middle + half, middle + half)
+        times = []
+        for draw in [lambda cr: renderer.draw_graph(cr, box, scale),
+                     lambda cr: renderer.draw_snapshot(cr, snapshot, scale,
+                                                       box)]:
+            cr = cairo.Context(surface)
+            cr.scale(scale, scale)
+            cr.translate(-box[0], -box[1])
+            times.append(timeIt(draw, cr))
+        print '  zoom %5.2f: %8.3fs %8.3fs' % ((scale,) + tuple(times))
+
+def benchMiniMap(sizes):
+    try:
+        import cairo
+        from Controller import Controller
+        from GraphArea import GraphArea
+        from MiniMap import MiniMap
+    except ImportError, e:
+        print 'Updating the minimap: skipped (%s)' % e
+        return
+    controller = Controller()
+    controller.graph = graph = localGraph(100000)
+    controller.spatial = GraphIndex(graph)
+    area = GraphArea(controller)
+    miniMap = MiniMap(controller, area)
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, 200, 200)
+    print 'Minimap of a 100000 state graph'
+    first = timeIt(miniMap.render, cairo.Context(surface), 200, 200)
+    print '  drawn in %.3fs' % first
+    rng = random.Random(0)
+    start = time()
+    for _ in xrange(100):
+        state = graph.getState(rng.randrange(graph.numStates()))
+        graph.moveState(state.index, state.x + 30, state.y)
+        miniMap.update()
+        miniMap.render(cairo.Context(surface), 200, 200)
+    print '  each move %.1fms' % ((time() - start) * 10)
+    area.rasterizer.stop()
+
+def historySize(history):
+    ''' Returns the bytes held by the entries of an undo stack '''
+    return sum(sys.getsizeof(item) + sum(sys.getsizeof(part)
+                                         for part in item)
+               for item in history.undo_stack)
+
+def benchTyping(sizes):
+    rng = random.Random(0)
+    words = ['the', 'castle', 'door', 'opens', 'onto', 'a', 'long',
+             'dark', 'hall', 'with', 'torches', 'on', 'walls']
+    paragraph = ''
+    while len(paragraph) < 2000:
+        paragraph += rng.choice(words) + ' '
+    print 'Undo history after typing 2000 characters into a state'
+    graph = Graph()
+    graph.addState('')
+    snapshots = Undo(None, graph)
+    diffs = Undo(None, graph)
+    start = time()
+    for i in xrange(len(paragraph)):
+        text = paragraph[:i + 1]
+        old = graph.setText(0, text)
+        snapshots.pushHistory((0, 'text', old))
+    snapshotTime = time() - start
+    graph.setText(0, '')
+    start = time()
+    for i in xrange(len(paragraph)):
+        text = paragraph[:i + 1]
+        old = graph.setText(0, text)
+        diffs.pushTextEdit(0, old, text)
+    diffTime = time() - start
+    for (name, history, seconds) in [('full texts', snapshots, snapshotTime),
+                                     ('merged diffs', diffs, diffTime)]:
+        print '  %-12s %5d entries, %9d bytes, %.3fs' % (
+            name, len(history.undo_stack), historySize(history), seconds)
+
+def benchNotify(sizes):
+    try:
+        from Controller import Controller
+        from GraphArea import GraphArea
+        from View import StatePane
+        from Undo import Undo
+    except ImportError, e:
+        print 'Sending updates: skipped (%s)' % e
+        return
+    controller = Controller()
+    controller.graph = graph = localGraph(500)
+    controller.extent = Extent(graph)
+    controller.spatial = GraphIndex(graph)
+    controller.history = Undo(controller, graph)
+    area = GraphArea(controller)
+    pane = StatePane(controller)
+    rng = random.Random(0)
+    print 'Sending updates for 500 rounds of edits'
+    start = time()
+    for _ in xrange(500):
+        # Everything done between two idle times of the main loop
+        controller.createState(None)
+        n = graph.numStates()
+        controller.createTransition(None, ('go', rng.randrange(n)))
+        controller.selectState(rng.randrange(n))
+        controller.selectState(rng.randrange(n))
+        for _ in xrange(3):
+            controller.moveState(controller.selection,
+                                 (rng.randrange(2000), rng.randrange(2000)))
+        controller.undo(None)
+        controller.redo(None)
+        controller.flushChanges()
+    seconds = time() - start
+    print '  %.3fs, %d listener runs, %d avoided' % (
+        seconds, controller.listenerRuns, controller.listenerRunsAvoided())
+    area.rasterizer.stop()
+
+def benchStatePane(sizes):
+    try:
+        from Controller import Controller, Change
+        from View import StatePane
+    except ImportError, e:
+        print 'State pane updates: skipped (%s)' % e
+        return
+    print 'State pane updates (select, text edit, remove and undo, ' \
+          'full refill)'
+    for n in sizes:
+        controller = Controller()
+        controller.graph = graph = localGraph(n)
+        controller.history = Undo(controller, graph)
+        pane = StatePane(controller)
+        rng = random.Random(0)
+        start = time()
+        for _ in xrange(100):
+            controller.selection = rng.randrange(n)
+            pane.update(Change('select', controller.selection))
+        select = (time() - start) * 10
+        start = time()
+        for _ in xrange(100):
+            controller.getCurrentState().setText('Edited text')
+            pane.update(Change('text', controller.selection))
+        text = (time() - start) * 10
+        start = time()
+        for _ in xrange(100):
+            controller.selection = rng.randrange(1, n)
+            controller.removeState(None)
+            controller.flushChanges()
+            controller.undo(None)
+            controller.flushChanges()
+        undo = (time() - start) * 10
+        start = time()
+        pane.update(Change('all'))
+        refill = (time() - start) * 1000
+        print '  %6d states: %.2fms %.2fms %.2fms %.1fms' % (
+            n, select, text, undo, refill)
+
+benchmarks = [
+    ('save', benchSave),
+    ('remove', benchRemove),
+    ('check', benchCheck),
+    ('analysis', benchAnalysis),
+    ('compact', benchCompact),
+    ('minimize', benchMinimize),
+    ('load', benchLoad),
+    ('binary', benchBinary),
+    ('memory', benchMemory),
+    ('spatial', benchSpatial),
+    ('search', benchSearch),
+    ('draw', benchDraw),
+    ('edges', benchEdges),
+    ('selection', benchSelection),
+    ('zoom', benchZoom),
+    ('minimap', benchMiniMap),
+    ('typing', benchTyping),
+    ('notify', benchNotify),
+    ('pane', benchStatePane),
+    ]
+
+def main(args):
+    sizes = [1000, 2000, 4000, 8000, 16000]
+    names = args or [name for (name, _) in benchmarks]
+    for (name, function) in benchmarks:
+        if name in names:
+            function(sizes)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+''' A binary .game format that can be opened with mmap. Opening a file
+only reads its header; the arrays and the text of each state are read
+from the mapped file when they are used.
+
+The file is a header followed by these sections, all little-endian:
+
+    xs, ys        float64 per state
+    intFlags      uint8 per state: INT_X and INT_Y for the coordinates
+                  that were integers
+    ends          uint8 per state
+    offsets       uint32 per state, plus one
+    commands      uint32 per transition (index into the labels)
+    targets       uint32 per transition
+    textOffsets   uint32 per state, plus one
+    labelOffsets  uint32 per label, plus one
+    texts         UTF-8 text of the states, back to back
+    labels        UTF-8 command labels, back to back
+
+To convert between formats:
+
+    $ ./Binary.py samples/castle.game castle.bgame
+'''
+
+import sys
+import mmap
+import struct
+from array import array
+
+from Compact import *
+
+MAGIC = 'DFAG'
+VERSION = 1
+EXTENSION = '.bgame'
+
+# Magic, version, numStates, numEdges, numLabels, then the offset of
+# each section
+HEADER = struct.Struct('<4sIIII10Q')
+
+class MappedArray:
+    ''' A read-only array of numbers stored in a buffer '''
+
+    def __init__(self, buf, offset, code, length):
+        self.buf = buf
+        self.offset = offset
+        self.item = struct.Struct('<' + code)
+        self.itemsize = self.item.size
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('MappedArray index out of range')
+        return self.item.unpack_from(self.buf,
+                                     self.offset + i * self.itemsize)[0]
+
+    def __iter__(self):
+        for i in xrange(self.length):
+            yield self[i]
+
+class StringTable:
+    ''' A read-only list of strings stored in a buffer, decoded when
+    each one is accessed '''
+
+    def __init__(self, buf, offsets, start):
+        self.buf = buf
+        self.offsets = offsets
+        self.start = start
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        begin = self.start + self.offsets[i]
+        end = self.start + self.offsets[i + 1]
+        return self.buf[begin:end].decode('utf-8')
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+def packArray(code, values):
+    ''' Returns values as a little-endian byte string '''
+    packed = array(code, values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed.tostring()
+
+def packStrings(strings):
+    ''' Returns the UTF-8 text of strings back to back, and the byte
+    string of their offsets '''
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = array('I', [0])
+    size = 0
+    for s in encoded:
+        size += len(s)
+        if size >= 1 << 32:
+            raise ValueError('Too much text for the binary format')
+        offsets.append(size)
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    return ''.join(encoded), offsets.tostring()
+
+def saveBinary(graph, filename):
+    ''' Saves a Graph or CompactGraph to the given file name in the
+    binary format '''
+    if not isinstance(graph, CompactGraph):
+        graph = compactGraph(graph)
+    texts, textOffsets = packStrings(graph.texts)
+    labels, labelOffsets = packStrings(graph.labels)
+    intFlags = graph.intFlags
+    if intFlags is None:
+        intFlags = array('B', [0]) * graph.numStates()
+    sections = [
+        packArray('d', graph.xs),
+        packArray('d', graph.ys),
+        packArray('B', intFlags),
+        packArray('B', graph.ends),
+        packArray('I', graph.offsets),
+        packArray('I', graph.commands),
+        packArray('I', graph.targets),
+        textOffsets,
+        labelOffsets,
+        texts,
+        labels,
+        ]
+    # Work out where each section starts (the last one is implied)
+    starts = []
+    position = HEADER.size
+    for section in sections[:-1]:
+        starts.append(position)
+        position += len(section)
+    header = HEADER.pack(MAGIC, VERSION, graph.numStates(),
+                         graph.numEdges(), len(graph.labels), *starts)
+    with open(filename, 'wb') as outf:
+        outf.write(header)
+        for section in sections:
+            outf.write(section)
+
+def loadBinary(filename):
+    ''' Opens a file in the binary format as a CompactGraph. Only the
+    header is read now; everything else is read from the mapped file
+    as it is used. '''
+    with open(filename, 'rb') as inf:
+        buf = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(buf) < HEADER.size:
+        raise ValueError('Not a binary game file')
+    fields = HEADER.unpack_from(buf, 0)
+    magic, version, numStates, numEdges, numLabels = fields[:5]
+    (xs, ys, intFlags, ends, offsets, commands, targets, textOffsets,
+     labelOffsets, texts) = fields[5:]
+    if magic != MAGIC:
+        raise ValueError('Not a binary game file')
+    if version != VERSION:
+        raise ValueError('Unsupported binary game version %d' % version)
+    textOffsets = MappedArray(buf, textOffsets, 'I', numStates + 1)
+    labelOffsets = MappedArray(buf, labelOffsets, 'I', numLabels + 1)
+    labels = texts + textOffsets[numStates]
+    return CompactGraph(
+        StringTable(buf, textOffsets, texts),
+        MappedArray(buf, xs, 'd', numStates),
+        MappedArray(buf, ys, 'd', numStates),
+        MappedArray(buf, ends, 'B', numStates),
+        MappedArray(buf, offsets, 'I', numStates + 1),
+        MappedArray(buf, commands, 'I', numEdges),
+        MappedArray(buf, targets, 'I', numEdges),
+        StringTable(buf, labelOffsets, labels),
+        MappedArray(buf, intFlags, 'B', numStates))
+
+def isBinary(filename):
+    ''' Returns True if the file is in the binary format '''
+    with open(filename, 'rb') as inf:
+        return inf.read(len(MAGIC)) == MAGIC
+
+def loadGame(filename):
+    ''' Loads a CompactGraph from a file in either format '''
+    if isBinary(filename):
+        return loadBinary(filename)
+    return loadCompact(filename)
+
+def main(args):
+    if len(args) != 2:
+        print 'Usage: Binary.py <from file> <to file>'
+        print 'Files ending in %s are written in the binary format' % (
+            EXTENSION)
+        return 1
+    source, dest = args
+    graph = loadGame(source)
+    if dest.endswith(EXTENSION):
+        saveBinary(graph, dest)
+    else:
+        saveGraph(graph, dest)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
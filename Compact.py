@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+from array import array
+from collections import deque
+
+from Model import *
+
+# Flags for the coordinates of a position that were integers
+INT_X = 1
+INT_Y = 2
+
+class CompactGraph:
+    ''' A read-only graph stored in flat arrays instead of State
+    objects. States are referred to by index and commands are interned
+    into a table of labels. The transitions out of state i are
+    commands[offsets[i]:offsets[i+1]], leading to the states in
+    targets over the same range.
+
+    Positions are stored as floats. So that they are written back the
+    way they were read, intFlags has INT_X set for each state whose x
+    was an integer, and INT_Y for y (if None, none were). '''
+
+    def __init__(self, texts, xs, ys, ends, offsets, commands, targets,
+                 labels, intFlags=None):
+        self.texts = texts
+        self.xs = xs
+        self.ys = ys
+        self.intFlags = intFlags
+        self.ends = ends
+        self.offsets = offsets
+        self.commands = commands
+        self.targets = targets
+        self.labels = labels
+        # Transitions by ending state, built when first needed
+        self.inOffsets = None
+        self.sources = None
+
+    def numStates(self):
+        ''' Returns the number of states '''
+        return len(self.offsets) - 1
+
+    def numEdges(self):
+        ''' Returns the total number of transitions '''
+        return len(self.targets)
+
+    def getText(self, index):
+        ''' Gets the text of the state at the given index '''
+        return self.texts[index]
+
+    def getPosition(self, index):
+        return (self.xs[index], self.ys[index])
+
+    def isEnd(self, index):
+        ''' Returns True if the state is an ending state '''
+        return bool(self.ends[index])
+
+    def numTransitions(self, index):
+        ''' Returns the number of transitions out of a state '''
+        return self.offsets[index + 1] - self.offsets[index]
+
+    def listTransitions(self, index):
+        ''' Returns a list of (command, stateIndex) pairs for the
+        transitions out of a state '''
+        labels, commands, targets = self.labels, self.commands, self.targets
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        return [(labels[commands[k]], targets[k])
+                for k in xrange(start, stop)]
+
+    def getTransition(self, index, command):
+        ''' Returns the index of the state reached from a state with
+        the given command, or None if there is no such transition '''
+        labels, commands = self.labels, self.commands
+        for k in xrange(self.offsets[index], self.offsets[index + 1]):
+            if labels[commands[k]] == command:
+                return self.targets[k]
+        return None
+
+    def getEndingStates(self):
+        ''' Returns a list of all ending states '''
+        return [i for (i, end) in enumerate(self.ends) if end]
+
+    def _buildIncoming(self):
+        ''' Builds the arrays of transitions by ending state '''
+        n = self.numStates()
+        offsets, targets = self.offsets, self.targets
+        # Count the transitions into each state
+        inOffsets = array('i', [0]) * (n + 1)
+        for t in targets:
+            inOffsets[t + 1] += 1
+        for i in xrange(n):
+            inOffsets[i + 1] += inOffsets[i]
+        # Place each starting state in its slot
+        fill = array('i', inOffsets)
+        sources = array('i', [0]) * len(targets)
+        for i in xrange(n):
+            for k in xrange(offsets[i], offsets[i + 1]):
+                t = targets[k]
+                sources[fill[t]] = i
+                fill[t] += 1
+        self.inOffsets = inOffsets
+        self.sources = sources
+
+    def _search(self, start, offsets, targets):
+        ''' Breadth-first search over one of the edge arrays. Returns
+        an array of flags for the states reached. '''
+        reached = array('b', [0]) * self.numStates()
+        for i in start:
+            reached[i] = 1
+        queue = deque(start)
+        while queue:
+            i = queue.popleft()
+            for k in xrange(offsets[i], offsets[i + 1]):
+                t = targets[k]
+                if not reached[t]:
+                    reached[t] = 1
+                    queue.append(t)
+        return reached
+
+    def getUnreachable(self):
+        ''' Returns a list of any unreachable states '''
+        reached = self._search([0], self.offsets, self.targets)
+        return [i for (i, r) in enumerate(reached) if not r]
+
+    def countUnreachable(self):
+        ''' Returns the number of unreachable states '''
+        return len(self.getUnreachable())
+
+    def getInescapable(self):
+        ''' Returns a list of inescapable states (those from which an
+        ending state cannot be reached) '''
+        if self.inOffsets is None:
+            self._buildIncoming()
+        reachEnd = self._search(self.getEndingStates(),
+                                self.inOffsets, self.sources)
+        return [i for (i, r) in enumerate(reachEnd) if not r]
+
+    def toSerializable(self):
+        ''' Converts graph into a format that can be serialized into
+        JSON'''
+        return map(self.serializeState, xrange(self.numStates()))
+
+    def serializeState(self, index):
+        x, y = self.xs[index], self.ys[index]
+        if self.intFlags is not None:
+            flags = self.intFlags[index]
+            if flags & INT_X:
+                x = int(x)
+            if flags & INT_Y:
+                y = int(y)
+        return {
+            'state': self.texts[index],
+            'x': x, 'y': y,
+            'end': bool(self.ends[index]),
+            'transitions': dict(self.listTransitions(index)) }
+
+    def toGraph(self):
+        ''' Converts this into an editable Graph '''
+        return Graph(serialized=self.toSerializable())
+
+    def sizeInBytes(self):
+        ''' Returns the memory used by the arrays (not counting the
+        text of the states) '''
+        arrays = [self.xs, self.ys, self.ends, self.offsets,
+                  self.commands, self.targets]
+        if self.intFlags is not None:
+            arrays.append(self.intFlags)
+        if self.inOffsets is not None:
+            arrays += [self.inOffsets, self.sources]
+        return sum(a.itemsize * len(a) for a in arrays)
+
+
+def compactSerialized(serialized):
+    ''' Builds a CompactGraph from the serialized format (or any
+    iterable of serialized states) '''
+    texts = []
+    xs, ys = array('d'), array('d')
+    intFlags = array('B')
+    ends = array('b')
+    offsets = array('i', [0])
+    commands, targets = array('i'), array('i')
+    labels = []
+    labelIds = dict()
+    for st in serialized:
+        texts.append(st['state'])
+        xs.append(st['x'])
+        ys.append(st['y'])
+        intFlags.append((INT_X if isinstance(st['x'], (int, long)) else 0) |
+                        (INT_Y if isinstance(st['y'], (int, long)) else 0))
+        ends.append(1 if st['end'] else 0)
+        for (cmd, j) in st['transitions'].iteritems():
+            if cmd not in labelIds:
+                labelIds[cmd] = len(labels)
+                labels.append(cmd)
+            commands.append(labelIds[cmd])
+            targets.append(j)
+        offsets.append(len(targets))
+    return CompactGraph(texts, xs, ys, ends, offsets, commands, targets,
+                        labels, intFlags)
+
+def compactGraph(graph):
+    ''' Builds a CompactGraph from a Graph '''
+    return compactSerialized(
+        graph.serializeState(i) for i in xrange(graph.numStates()))
+
+def loadCompact(filename):
+    ''' Loads a CompactGraph from a file '''
+    with open(filename) as inf:
+        return compactSerialized(iterSerialized(inf))
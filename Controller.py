@@ -2,10 +2,30 @@
 from os import path
 
 from Model import *
+from Spatial import *
+from Search import *
 from Undo import *
 from View import *
 from PlayWindow import *
 
+# Kinds of change that leave nothing more to update when made again
+REPEATABLE = ('select', 'text', 'end', 'move')
+
+def mergeChanges(changes):
+    ''' Returns one Change covering a list of them: the last one if
+    they all repeated the same change, a 'select' from the first to the
+    last if they were all selections, or else 'all' '''
+    first, last = changes[0], changes[-1]
+    if len(changes) == 1:
+        return last
+    if last.kind in REPEATABLE and all(
+            c.kind == last.kind and c.index == last.index and
+            c.command == last.command for c in changes):
+        return last
+    if all(c.kind == 'select' for c in changes):
+        return Change('select', last.index, old=first.old)
+    return Change('all')
+
 class Controller:
     ''' Handles connection between the 
     view and the model, and keeps some
@@ -20,12 +40,18 @@ class Controller:
         # Set up listeners
         self.listeners = set()
         self.fileListeners = set()
+        self.changeListeners = set()
+        # Changes waiting to be sent when the main loop is next idle,
+        # and whether any of them was more than a file state update
+        self.pendingChanges = []
+        self.pendingGraph = False
+        # Number of times a listener would have run, and did run
+        self.listenerCalls = 0
+        self.listenerRuns = 0
 
     def resetGraph(self):
         ''' Reset to a new graph '''
         # Graph display values
-        self.maxXdist = 0
-        self.maxYdist = 0
         self.space = 50
         self.nPositions = 0
         self.selection = 0
@@ -34,14 +60,20 @@ class Controller:
         self.unsavedChanges = False
         # Graph
         self.graph = Graph()
+        self.extent = Extent(self.graph)
         state = self.graph.addState('Start state')
         self.setPosition(state)
+        self.spatial = GraphIndex(self.graph)
+        self.search = SearchIndex(self.graph)
         # Undo state
         self.history = Undo(self, self.graph)
 
 
     def main(self):
         ''' This method starts the program '''
+        # Let the graph area draw on a worker thread (which it starts
+        # when the window is built)
+        gobject.threads_init()
         self.builderWindow = BuilderWindow(self)
         # Transfer control to GTK event loop
         gtk.main()
@@ -56,21 +88,52 @@ class Controller:
     # (i.e. observer pattern)
     # ----------------------------------
 
-    def registerListener(self, function, fileUpdates=False):
+    def registerListener(self, function, fileUpdates=False,
+                         changes=False):
         ''' Adds a listener function (which should have no 
         arguments) to the list that will be updated. Set 
-        fileUpdates to True to get updates on file state. '''
+        fileUpdates to True to get updates on file state. Set
+        changes to True to have the function called with a Change
+        describing each update. '''
         self.listeners.add(function)
         if fileUpdates:
             self.fileListeners.add(function)
+        if changes:
+            self.changeListeners.add(function)
 
-    def notifyListeners(self, updateGraph=True):
+    def notifyListeners(self, updateGraph=True, change=None):
         ''' Notifies the listeners that had registered.  Setting
         updateGraph to False will cause only listeners registerd for
-        file state updates to be notified. '''
+        file state updates to be notified. change is the Change
+        passed to listeners that want one (by default, 'all').
+
+        The listeners are not called right away: all the updates made
+        until the main loop is idle are sent together, so each listener
+        runs once for them. '''
 
         # Don't notify recursively:
         if self.notifying: return
+
+        if change is None:
+            change = Change('all')
+        self.listenerCalls += len(self.listeners if updateGraph
+                                  else self.fileListeners)
+        if not self.pendingChanges:
+            # Run before the main loop redraws the windows
+            gobject.idle_add(self.flushChanges,
+                             priority=gobject.PRIORITY_HIGH_IDLE)
+        self.pendingChanges.append(change)
+        self.pendingGraph |= updateGraph
+
+    def flushChanges(self):
+        ''' Sends the pending updates to the listeners now '''
+        if not self.pendingChanges:
+            return False
+        change = mergeChanges(self.pendingChanges)
+        updateGraph = self.pendingGraph
+        self.pendingChanges = []
+        self.pendingGraph = False
+
         self.notifying = True
 
         # Select who to notify
@@ -78,10 +141,20 @@ class Controller:
 
         # Notify all selected
         for function in listeners:
-            function()
+            self.listenerRuns += 1
+            if function in self.changeListeners:
+                function(change)
+            else:
+                function()
 
         # Allow notifications again
         self.notifying = False
+        return False
+
+    def listenerRunsAvoided(self):
+        ''' Returns how many listener calls were saved by sending
+        updates together '''
+        return self.listenerCalls - self.listenerRuns
 
     # ----------------------------------
     # Functions for getting state
@@ -112,19 +185,17 @@ class Controller:
         self.history.pushHistory((self.selection, 'added'))
         # Update
         self.setPosition(state)
-        self.notifyListeners()
-
-    def selectStateListener(self, widget):
-        ''' Call back for widgets that change the 
-        selection '''
-        self.selectState(widget.get_active())
+        self.notifyListeners(change=Change('added', self.selection))
 
     def selectState(self, index):
         ''' Changes the current selection '''
         if index >= 0 and index != self.selection:
+            # Edits to the next state's text are a new undo step
+            self.history.stopCoalescing()
             oldSelection = self.selection
             self.selection = index
-            self.notifyListeners()
+            self.notifyListeners(change=Change('select', index,
+                                               old=oldSelection))
 
     def removeState(self, widget):
         ''' Removes the selected state (if it is not the 
@@ -139,22 +210,21 @@ class Controller:
         #  undo history
         self.history.pushHistory(history)
         # Update
-        self.recalcPositions()
-        self.notifyListeners()
+        self.notifyListeners(change=Change('removed', num))
 
     def updateStateText(self, widget):
         ''' Changes the text of the current state '''
-        self.unsavedChanges = True
-        # Make change
-        state = self.getCurrentState()
         text = widget.get_text(widget.get_start_iter(), \
                                widget.get_end_iter())
-        old = state.setText(text)
-        # Store undo history
-        hist = (self.selection, 'text', old)
-        self.history.pushHistory(hist)
+        if text == self.graph.getText(self.selection):
+            return
+        self.unsavedChanges = True
+        # Make change
+        old = self.graph.setText(self.selection, text)
+        # Store undo history (typing into the same state is one change)
+        self.history.pushTextEdit(self.selection, old, text)
         # No re-draw needed, just 'saved' state
-        self.notifyListeners(False)
+        self.notifyListeners(False, Change('text', self.selection))
 
     def createTransition(self, widget, data=None):
         ''' Creates a new transition from the current state '''
@@ -171,7 +241,8 @@ class Controller:
         self.history.pushHistory(hist)
         # Make change & update
         self.graph.addTransition(start, end, command)
-        self.notifyListeners()
+        self.notifyListeners(change=Change('addtr', self.selection,
+                                           command))
         return True
 
     def removeTransition(self, widget, command):
@@ -181,7 +252,7 @@ class Controller:
         history = self.graph.removeTransition(self.selection, command)
         # Store undo history
         self.history.pushHistory(history)
-        self.notifyListeners()
+        self.notifyListeners(change=Change('rmtr', self.selection, command))
 
     def setEndingState(self, widget):
         ''' Changes whether the selected state is an ending 
@@ -197,55 +268,28 @@ class Controller:
             hist = (self.selection, 'end', old_isEnding)
             self.history.pushHistory(hist)
             # Make change & update
-            state.end = isEnding
-            self.notifyListeners()
+            self.graph.setEnd(self.selection, isEnding)
+            self.notifyListeners(change=Change('end', self.selection))
 
     def undo(self, menu, data=None):
         # Undo the action
-        self.history.undo()
+        change = self.history.undo()
+        if change is None: return
         # Update
         self.unsavedChanges = self.history.unsavedChanges()
-        self.notifyListeners()
+        self.notifyListeners(change=change)
             
     def redo(self, menu, data=None):
         # Get the redo history
-        self.history.redo()
+        change = self.history.redo()
+        if change is None: return
         # Update
         self.unsavedChanges = self.history.unsavedChanges()
-        self.notifyListeners()
+        self.notifyListeners(change=change)
 
     def checkGame(self, menu, data=None):
-        problems = []
-        warnings = []
-        g = self.graph
-
-        # Check for states with no text
-        for i in xrange(g.numStates()):
-            st = g.getState(i)
-            if not st.text.strip():
-                warnings.append('State #%d has no text.' % i)
-
-        # Ensure there are ending states
-        endingStates = g.getEndingStates()
-        if not endingStates:
-            problems.append('There are no ending states.')
-
-        # Check for transitions out of ending states
-        for i in endingStates:
-            endst = g.getState(i)
-            if endst.transitions:
-                problems.append(
-                    'End state #%d has exiting transitions.' % i)
-
-        # Check for unreachable states
-        if g.getUnreachable():
-            problems.append('There are unreachable states.')
-
-        # Check for states that cannot reach an ending state
-        inescapable = g.getInescapable()
-        for i in inescapable:
-            problems.append('State #%d cannot reach an end state.' % i)
-        
+        problems, warnings = checkGraph(self.graph)
+
         # Output results
         m = '%d problems\n%s\n\n%d warnings\n%s' %(
             len(problems), '\n'.join(problems), 
@@ -273,7 +317,7 @@ class Controller:
             self.fileOpen = filename
             self.unsavedChanges = False
             self.history.stateSaved()
-            self.notifyListeners(False)
+            self.notifyListeners(False, Change('saved'))
             return True
         return False
 
@@ -294,11 +338,22 @@ class Controller:
 
     def loadGraph(self, filename):
         ''' Handles loading a graph '''
-        self.graph = loadGraph(filename)
+        # Show the progress, keeping the window from being used until
+        # the graph is loaded
+        window = self.builderWindow
+        window.vb.set_sensitive(False)
+        try:
+            self.graph = loadGraph(filename, window.showProgress)
+        finally:
+            window.hideProgress()
+            window.vb.set_sensitive(True)
         self.unsavedChanges = False
         self.fileOpen = filename
+        self.extent = Extent(self.graph)
         for state in self.graph.states:
             self.setPosition(state)
+        self.spatial = GraphIndex(self.graph)
+        self.search = SearchIndex(self.graph)
         self.selection = 0
         self.history = Undo(self, self.graph)
         self.notifyListeners()
@@ -326,7 +381,7 @@ class Controller:
     def getNextPosition(self):
         ''' Computes and available position for 
         placing the node. '''
-        xd, yd = self.maxXdist, self.maxYdist
+        xd, yd = self.extent.largest()
         sp = self.space
         if xd < yd: return (xd + sp, sp)
         else:       return (sp, yd + sp)
@@ -340,35 +395,20 @@ class Controller:
         self.history.pushHistory(hist)
         # Make change & update
         self.setStatePosition(state, position)
-        self.notifyListeners()
+        self.notifyListeners(change=Change('move', stateNo))
 
     def setStatePosition(self, state, position):
         ''' Updates or sets the position of a state 
         (Don't use directly)'''
-        # Make change
+        # Make change (self.extent follows it)
         x, y = position
-        state.setPosition(x, y)
-        # Update dimensions
-        self.recalcPositions()
-
-    def recalcPositions(self):
-        ''' Recalculates the dimensions after a removal '''
-        xmax, ymax = 0, 0 # assuming positions are positive
-        for state in self.graph.states:
-            x, y = state.getPosition()
-            xmax = max(xmax, x)
-            ymax = max(ymax, y)
-        self.maxXdist = xmax
-        self.maxYdist = ymax
+        self.graph.moveState(state.index, x, y)
 
     def setPosition(self, state):
         ''' Sets up the position of a newly added state '''
         x, y = state.getPosition()
         if not x or not y:
             self.setStatePosition(state, self.getNextPosition())
-        else:
-            self.maxXdist = max(self.maxXdist, x)
-            self.maxYdist = max(self.maxYdist, y)
         
 
     # ----------------------------------
@@ -385,9 +425,8 @@ class Controller:
         
         # Unless the game will start from the selected
         # state, move to the start state
-        if menu != 1:
-            self.selection = 0
-            self.notifyListeners()
+        if menu != 1 and self.selection != 0:
+            self.selectState(0)
 
         # Show window
         PlayWindow(self)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+''' Draws games to PNG, SVG or PDF files without opening any windows.
+
+    $ ./Export.py samples/castle.game -o castle.svg
+    $ ./Export.py samples/*.game --format pdf --jobs 4
+    $ ./Export.py huge.game --tile 4096
+
+With --tile, a drawing larger than the tile size is split into files
+named like huge-0-1.png (row 0, column 1).
+'''
+
+import os
+import sys
+import argparse
+from math import ceil
+from multiprocessing import Pool
+
+import cairo
+
+from Binary import *
+from Spatial import *
+from Render import *
+
+FORMATS = ('png', 'svg', 'pdf')
+
+def openGraph(filename):
+    ''' Loads a Graph from a file in either format '''
+    if isBinary(filename):
+        return loadBinary(filename).toGraph()
+    return loadGraph(filename)
+
+def createSurface(format, filename, width, height):
+    if format == 'svg':
+        return cairo.SVGSurface(filename, width, height)
+    if format == 'pdf':
+        return cairo.PDFSurface(filename, width, height)
+    return cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+
+def drawPart(renderer, format, filename, box, width, height):
+    ''' Draws the part of the graph in box, which starts at the top
+    left of a drawing of the given size, to a file '''
+    surface = createSurface(format, filename, width, height)
+    cr = cairo.Context(surface)
+    cr.set_source_rgb(1, 1, 1)
+    cr.paint()
+    cr.translate(-box[0], -box[1])
+    renderer.draw_graph(cr, box)
+    if format == 'png':
+        surface.write_to_png(filename)
+    surface.finish()
+
+def exportGraph(graph, filename, format=None, margin=20, tileSize=None):
+    ''' Draws a Graph to a file, or to several files of at most tileSize
+    pixels across. The format is taken from the file name if not
+    given. Returns the list of files written. '''
+    base, ext = os.path.splitext(filename)
+    if format is None:
+        format = ext[1:].lower()
+    if format not in FORMATS:
+        raise ValueError('Unknown format %r' % format)
+    renderer = Renderer(graph, GraphIndex(graph))
+    bounds = renderer.bounds() or (0, 0, 0, 0)
+    x0, y0 = bounds[0] - margin, bounds[1] - margin
+    width = int(ceil(bounds[2] + margin - x0))
+    height = int(ceil(bounds[3] + margin - y0))
+    if not tileSize or (width <= tileSize and height <= tileSize):
+        box = (x0, y0, x0 + width, y0 + height)
+        drawPart(renderer, format, filename, box, width, height)
+        return [filename]
+    written = []
+    for row in xrange((height + tileSize - 1) // tileSize):
+        for column in xrange((width + tileSize - 1) // tileSize):
+            left, top = column * tileSize, row * tileSize
+            w = min(tileSize, width - left)
+            h = min(tileSize, height - top)
+            box = (x0 + left, y0 + top, x0 + left + w, y0 + top + h)
+            name = '%s-%d-%d%s' % (base, row, column, ext)
+            drawPart(renderer, format, name, box, w, h)
+            written.append(name)
+    return written
+
+def exportFile((source, dest, format, tileSize)):
+    ''' Draws a game file, returning the list of files written '''
+    return exportGraph(openGraph(source), dest, format,
+                       tileSize=tileSize)
+
+def exportFiles(jobs, processes=1):
+    ''' Runs a list of (source, dest, format, tileSize) jobs, over the
+    given number of processes. Returns the list of files written. '''
+    if processes <= 1:
+        results = map(exportFile, jobs)
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(exportFile, jobs)
+        finally:
+            pool.close()
+    return [name for written in results for name in written]
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Draws games to image files.')
+    parser.add_argument('games', nargs='+',
+                        help='.game or %s files to draw' % EXTENSION)
+    parser.add_argument('-o', '--output',
+                        help='file to write, when drawing one game')
+    parser.add_argument('-f', '--format', choices=FORMATS,
+                        help='file format (default: from the output '
+                        'file name, or png)')
+    parser.add_argument('-d', '--directory',
+                        help='directory to write to (default: next to '
+                        'each game)')
+    parser.add_argument('--tile', type=int, default=None,
+                        help='split drawings into tiles of at most this '
+                        'many pixels across')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes to use')
+    options = parser.parse_args(args)
+    if options.output and len(options.games) > 1:
+        parser.error('--output can only be used with one game')
+    jobs = []
+    for game in options.games:
+        if options.output:
+            dest = options.output
+        else:
+            dest = '%s.%s' % (os.path.splitext(game)[0],
+                              options.format or 'png')
+            if options.directory:
+                dest = os.path.join(options.directory,
+                                    os.path.basename(dest))
+        jobs.append((game, dest, options.format, options.tile))
+    for name in exportFiles(jobs, options.jobs):
+        print name
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+''' Geometry shared by the code that draws the graph and the code that
+finds what is where on it. '''
+
+from math import pi, sqrt, hypot, cos, sin, atan2, floor, ceil
+
+# Default sizes for drawing the graph
+RADIUS = 10
+ARC_SIZE = 0.8
+ARROW_LENGTH = 10
+# How far a node's drawing (selection, self-loops) reaches from its
+# center, in multiples of the radius
+NODE_REACH = 4
+
+def distance(x1, y1, x2, y2):
+    dx = abs(x1 - x2)
+    dy = abs(y1 - y2)
+    return sqrt(dx*dx + dy*dy)
+
+def get_vect(x1, y1, x2, y2):
+    ''' Returns the vector between the two points '''
+    return (x2 - x1), (y2 - y1)
+
+def get_offset_pt(x, y, vx, vy, scale):
+    ''' Calculates a point offset from a line '''
+    # 90 degree rotation & scale
+    x1, y1 = -vy * scale, vx * scale
+    # Midpoint of vector
+    x2, y2 = (vx * 0.5 + x), (vy * 0.5 + y)
+    # result
+    return (x1 + x2), (y1 + y2)
+
+def get_circle_intersection(x0, y0, r0, x1, y1, r1):
+    ''' Returns the first intersection of the circle at x0, y0 with
+    radius r0 and the circle at x1, y1 with radius r1'''
+    # Formule from http://local.wasp.uwa.edu.au/~pbourke/geometry/2circle/
+    d = hypot(x1 - x0, y1 - y0)
+    if d == 0:
+        return x1, y1
+    a = (r0**2 - r1**2 + d**2) / (2 * d)
+    # (Nodes closer than their radius don't intersect; use the
+    # nearest point instead of failing)
+    h = sqrt(max(r0**2 - a**2, 0))
+    x2 = x0 + (x1 - x0) * a/d
+    y2 = y0 + (y1 - y0) * a/d
+    x = x2 + (y1 - y0) * h/d
+    y = y2 - (x1 - x0) * h/d
+    return x, y
+
+def node_bounds(x, y, radius=RADIUS):
+    ''' Returns the box (x0, y0, x1, y1) around everything drawn for a
+    node, including its selection and self-loops '''
+    reach = radius * NODE_REACH
+    return (x - reach, y - reach, x + reach, y + reach)
+
+def edge_bounds((fromX, fromY), (toX, toY), arcSize=ARC_SIZE,
+                margin=ARROW_LENGTH):
+    ''' Returns the box (x0, y0, x1, y1) around the arc drawn for a
+    transition between two points, grown by margin on each side '''
+    vx, vy = get_vect(fromX, fromY, toX, toY)
+    cx, cy = get_offset_pt(fromX, fromY, vx, vy, arcSize)
+    radius = distance(cx, cy, fromX, fromY)
+    angle1 = atan2(fromY - cy, fromX - cx)
+    angle2 = atan2(toY - cy, toX - cx)
+    # The arc is drawn with increasing angle, like cairo's arc()
+    if angle2 < angle1:
+        angle2 += 2 * pi
+    xs = [fromX, toX]
+    ys = [fromY, toY]
+    # Add the extreme points of the circle that the arc passes
+    quarter = int(angle1 // (pi/2)) + 1
+    while quarter * pi/2 < angle2:
+        angle = quarter * pi/2
+        xs.append(cx + radius * cos(angle))
+        ys.append(cy + radius * sin(angle))
+        quarter += 1
+    return (min(xs) - margin, min(ys) - margin,
+            max(xs) + margin, max(ys) + margin)
+
+def overlaps((ax0, ay0, ax1, ay1), (bx0, by0, bx1, by1)):
+    ''' Returns True if two boxes overlap '''
+    return ax0 <= bx1 and bx0 <= ax1 and ay0 <= by1 and by0 <= ay1
+
+def bounding_box(boxes):
+    ''' Returns the box around a list of boxes '''
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+def pixel_rect((x0, y0, x1, y1)):
+    ''' Returns the (x, y, width, height) of whole pixels covering a
+    box, with a pixel to spare for antialiasing '''
+    x, y = int(floor(x0)) - 1, int(floor(y0)) - 1
+    return (x, y, int(ceil(x1)) + 1 - x, int(ceil(y1)) + 1 - y)
@@ -7,11 +7,9 @@ from math import pi, sqrt, hypot, cos, sin, atan2
 
 from Controller import *
 from Model import *
-
-def distance(x1, y1, x2, y2):
-    dx = abs(x1 - x2)
-    dy = abs(y1 - y2)
-    return sqrt(dx*dx + dy*dy)
+from Geometry import *
+from Spatial import *
+from Render import *
 
 class GraphArea(gtk.DrawingArea):
     __gsignals__ = { "expose-event": "override" }
@@ -19,24 +17,59 @@ class GraphArea(gtk.DrawingArea):
     def __init__(self, controller):
         gtk.DrawingArea.__init__(self)
         self.controller = controller
+        self.renderer = Renderer(controller.graph, controller.spatial)
         # Settings
-        self.radius = 10
         self.minDragDist = 5
-        self.arcSize = 0.8
-        self.arrowLength = 10
-        self.arrowAngle = pi/6
-        self.textSize = 10
+        # Past this many changed areas, just redraw everything
+        self.maxDamageBoxes = 64
+        # Graphs with at least this many states are redrawn in full on
+        # a worker thread
+        self.threadedStates = 2000
+        self.minScale = 0.005
+        self.maxScale = 8.0
+        self.zoomStep = 1.25
+        # The zoom, and the point of the graph at the top left corner
+        self.scale = 1.0
+        self.origin = (0, 0)
+        # Functions (with no arguments) to call when the view changes
+        self.viewListeners = []
         # Information for dragging nodes
         self.stateSelected = None
         self.dragStart = None
+        self.dragPos = None
+        # The mouse position and origin when panning started
+        self.panStart = None
         # Setup clicking on the graph
         self.add_events(gtk.gdk.BUTTON_PRESS_MASK | \
                         gtk.gdk.BUTTON_RELEASE_MASK | \
-                        gtk.gdk.POINTER_MOTION_MASK)
+                        gtk.gdk.POINTER_MOTION_MASK | \
+                        gtk.gdk.SCROLL_MASK)
         self.connect('button-press-event', self.cb_button_press)
         self.connect('button-release-event', self.cb_button_release)
+        self.connect('motion-notify-event', self.cb_motion)
+        self.connect('scroll-event', self.cb_scroll)
+        # Track which parts of the drawing need to be redrawn, and
+        # keep a snapshot of the graph ready for the worker thread
+        self.damage = self.track_damage()
+        self.snapshots = SnapshotTracker(controller.graph)
+        self.selectionBox = None
+        # Offscreen drawing of the transitions and nodes, the view it
+        # was drawn at, and the boxes of it that are out of date (None
+        # for all of it)
+        self.layer = None
+        self.layerView = None
+        self.layerDamage = None
+        # Full redraws being done on the worker thread: the number of
+        # the latest one asked for, the size and view it was asked for
+        # at, and the boxes changed since its snapshot was taken (None
+        # if it is out of date as a whole)
+        self.rasterizer = Rasterizer(self.renderer, self.cb_frame)
+        self.frameNumber = 0
+        self.frameRequest = None
+        self.frameDamage = None
+        self.connect('destroy', lambda widget: self.rasterizer.stop())
         # Set this to be re-rendered upon a state update
-        controller.registerListener(self.queue_draw)
+        controller.registerListener(self.update)
 
     # ----------------------------------
     # Functions for event handling
@@ -45,30 +78,162 @@ class GraphArea(gtk.DrawingArea):
     def cb_button_press(self, event, data):
         ''' Handle a mouse button press on the graph area '''
         if data.button == 1:
-            self.stateSelected = self.selectNode(data.x, data.y)
+            self.stateSelected = self.selectNode(*self.to_graph(data.x,
+                                                                data.y))
             self.dragStart = (data.x, data.y)
         else:
             self.stateSelected = None
+        if data.button == 2:
+            self.panStart = (data.x, data.y, self.origin)
 
     def cb_button_release(self, event, data):
         ''' Handle the end of a mouse button press on the graph area '''
+        self.panStart = None
         stateNo = self.stateSelected
+        self.stateSelected = None
+        self.set_drag_pos(None)
         if stateNo is not None:
             x, y = data.x, data.y
             if distance(x, y, *self.dragStart) >= self.minDragDist:
-                self.controller.moveState(stateNo, (x,y))
+                self.controller.moveState(stateNo, self.to_graph(x, y))
+
+    def cb_motion(self, event, data):
+        ''' Show where a node being dragged would go, or pan the view
+        while the middle button is held '''
+        x, y = data.x, data.y
+        if self.panStart is not None:
+            startX, startY, (originX, originY) = self.panStart
+            self.set_view(self.scale, (originX - (x - startX) / self.scale,
+                                       originY - (y - startY) / self.scale))
+            return
+        if self.stateSelected is None:
+            return
+        if distance(x, y, *self.dragStart) >= self.minDragDist:
+            self.set_drag_pos(self.to_graph(x, y))
+        else:
+            self.set_drag_pos(None)
+
+    def cb_scroll(self, event, data):
+        ''' Zoom in or out around the mouse '''
+        if data.direction == gtk.gdk.SCROLL_UP:
+            self.zoom(self.zoomStep, data.x, data.y)
+        elif data.direction == gtk.gdk.SCROLL_DOWN:
+            self.zoom(1 / self.zoomStep, data.x, data.y)
+
+    def set_drag_pos(self, position):
+        ''' Moves the preview of a dragged node '''
+        for pos in (self.dragPos, position):
+            if pos is not None:
+                self.queue_draw_box(node_bounds(pos[0], pos[1],
+                                                self.renderer.radius))
+        self.dragPos = position
+
+    # ----------------------------------
+    # Functions for zooming and panning
+    # ----------------------------------
+
+    def view(self):
+        ''' Returns the (scale, x, y) of the zoom and the point of the
+        graph at the top left corner '''
+        return (self.scale, self.origin[0], self.origin[1])
+
+    def set_view(self, scale, origin):
+        ''' Changes the zoom and the point at the top left corner '''
+        scale = min(max(scale, self.minScale), self.maxScale)
+        if (scale, origin) != (self.scale, self.origin):
+            self.scale = scale
+            self.origin = origin
+            self.layerDamage = None
+            self.queue_draw()
+            for listener in self.viewListeners:
+                listener()
+
+    def zoom(self, factor, x, y):
+        ''' Zooms by a factor, keeping the point under the window
+        position x, y in place '''
+        gx, gy = self.to_graph(x, y)
+        scale = min(max(self.scale * factor, self.minScale), self.maxScale)
+        self.set_view(scale, (gx - x / scale, gy - y / scale))
+
+    def to_graph(self, x, y):
+        ''' Converts a window position to graph coordinates '''
+        return (x / self.scale + self.origin[0],
+                y / self.scale + self.origin[1])
+
+    def to_window_box(self, (x0, y0, x1, y1)):
+        ''' Converts a box in graph coordinates to window coordinates '''
+        ox, oy = self.origin
+        s = self.scale
+        return ((x0 - ox) * s, (y0 - oy) * s, (x1 - ox) * s, (y1 - oy) * s)
+
+    def apply_view(self, cr):
+        ''' Makes cr draw in graph coordinates '''
+        cr.scale(self.scale, self.scale)
+        cr.translate(-self.origin[0], -self.origin[1])
 
     def selectNode(self, x, y):
         ''' Selects the node (if any) under 
         the mouse click '''
-        graph = self.controller.graph
-        for stateNo in xrange(graph.numStates()):
-             sx, sy = graph.getState(stateNo).getPosition()
-             if distance(x, y, sx, sy) <= self.radius:
-                 self.controller.selectState(stateNo)
-                 return stateNo
-        return None
+        state = self.controller.spatial.nodeAt(x, y)
+        if state is None:
+            return None
+        self.controller.selectState(state.index)
+        return state.index
              
+    # ----------------------------------
+    # Functions for updating
+    # ----------------------------------
+
+    def update(self):
+        ''' Queues redraws of the parts of the graph that changed '''
+        controller = self.controller
+        if self.damage.graph is not controller.graph:
+            # A different graph was loaded
+            self.damage.detach()
+            self.damage = self.track_damage()
+            self.snapshots.detach()
+            self.snapshots = SnapshotTracker(controller.graph)
+            self.renderer.setGraph(controller.graph, controller.spatial)
+            self.selectionBox = None
+            self.layerDamage = None
+            self.frameDamage = None
+            self.queue_draw()
+            return
+        boxes = self.damage.take()
+        # Bring the offscreen drawing up to date when it is next shown
+        if boxes is None:
+            self.layerDamage = None
+            # A full redraw already under way is out of date too
+            self.frameDamage = None
+        else:
+            if self.layerDamage is not None:
+                self.layerDamage.extend(boxes)
+            if self.frameDamage is not None:
+                self.frameDamage.extend(boxes)
+        # Redraw the old and new selection if it changed
+        x, y = controller.getCurrentState().getPosition()
+        selectionBox = node_bounds(x, y, self.renderer.radius)
+        if selectionBox != self.selectionBox:
+            if boxes is not None and self.selectionBox is not None:
+                boxes += [self.selectionBox, selectionBox]
+            self.selectionBox = selectionBox
+        if boxes is None or len(boxes) > self.maxDamageBoxes:
+            self.queue_draw()
+        else:
+            for box in boxes:
+                self.queue_draw_box(box)
+
+    def track_damage(self):
+        ''' Returns a DamageTracker for the current graph '''
+        renderer = self.renderer
+        return DamageTracker(self.controller.graph, renderer.radius,
+                             renderer.arcSize, renderer.arrowLength)
+
+    def queue_draw_box(self, box):
+        ''' Queues a redraw of the area covering a box in graph
+        coordinates '''
+        self.queue_draw_area(*pixel_rect(self.to_window_box(box)))
+
     # ----------------------------------
     # Functions for drawing
     # ----------------------------------
@@ -79,165 +244,130 @@ class GraphArea(gtk.DrawingArea):
         cr = self.window.cairo_create()
 
         # Restrict Cairo to the exposed area; avoid extra work
-        cr.rectangle(event.area.x, event.area.y,
-                event.area.width, event.area.height)
+        cr.region(event.region)
         cr.clip()
 
-        self.draw(cr, *self.window.get_size())
+        self.render(cr, *self.window.get_size())
 
-    def draw(self, cr, width, height):
+    def render(self, cr, width, height):
+        ''' Draws the selection and any drag preview, with the
+        offscreen drawing of the graph over them '''
+        self.update_layer(width, height)
         # Fill the background with white
         cr.set_source_rgb(1, 1, 1)
         cr.rectangle(0, 0, width, height)
         cr.fill()
-        self.draw_graph(cr)
-
-    def draw_graph(self, cr):
-        cr.set_line_width(1)
-
-        controller = self.controller
-        graph = controller.graph
-        npoints = graph.numStates()
-
-        green = (0, 0.8, 0)
-        red   = (1, 0, 0)
-        black = (0, 0, 0)
-
-        # Show current selection
-        x, y = controller.getCurrentState().getPosition()
-        self.draw_selection(cr, x, y)
-
-        # Draw transitions
-        for i in xrange(npoints):
-            fromState = graph.getState(i)
-            fromXY = fromState.getPosition()
-            for (_, toState) in fromState.listTransitions():
-                j = graph.getIndex(toState)
-                if i == j:
-                    self.draw_loop(cr, fromXY)
-                else:
-                    toXY = graph.getState(j).getPosition()
-                    self.draw_transition(cr, fromXY, toXY)
-
-        # Draw vertices
-        for i in xrange(npoints):
-            xy = graph.getState(i).getPosition()
-            if i == 0: 
-                color = green
-            elif graph.getState(i).end:
-                color = red
-            else:
-                color = black
-            self.draw_node(cr, xy, color, i)
-
-    def draw_selection(self, cr, x, y):
         cr.save()
-        cr.set_source_rgb(0.8, 0.8, 1.0)
-        cr.arc(x, y, self.radius + 4, 0, 2*pi)
-        cr.fill()
+        self.apply_view(cr)
+        self.draw_current_selection(cr)
         cr.restore()
+        if self.layer is not None:
+            cr.save()
+            if self.layerView != self.view():
+                # Stretch the old drawing to the new view until a new
+                # one is done
+                oldScale, oldX, oldY = self.layerView
+                cr.translate((oldX - self.origin[0]) * self.scale,
+                             (oldY - self.origin[1]) * self.scale)
+                cr.scale(self.scale / oldScale, self.scale / oldScale)
+            cr.set_source_surface(self.layer, 0, 0)
+            cr.paint()
+            cr.restore()
+        if self.dragPos is not None:
+            cr.save()
+            self.apply_view(cr)
+            self.renderer.draw_drag(cr, self.dragPos)
+            cr.restore()
 
+    def update_layer(self, width, height):
+        ''' Redraws the out of date parts of the offscreen drawing '''
+        layer = self.layer
+        view = self.view()
+        current = layer is not None and layer.get_width() == width \
+                and layer.get_height() == height and self.layerView == view
+        if (not current or self.layerDamage is None) and \
+                self.controller.graph.numStates() >= self.threadedStates:
+            # Keep showing the old drawing until the new one is done.
+            # Only one full redraw is under way at a time, so the views
+            # passed through while dragging or zooming are skipped: the
+            # next one is asked for when it is shown.
+            if self.frameRequest is None:
+                self.request_frame(width, height)
+            return
+        elif not current:
+            if layer is None or layer.get_width() != width \
+                    or layer.get_height() != height:
+                layer = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                           width, height)
+                self.layer = layer
+            self.layerView = view
+            self.layerDamage = None
+        damage = self.layerDamage
+        if damage is None:
+            damage = [self.to_graph(0, 0) + self.to_graph(width, height)]
+        elif len(damage) > self.maxDamageBoxes:
+            damage = [bounding_box(damage)]
+        cr = cairo.Context(layer)
+        for box in damage:
+            cr.save()
+            cr.rectangle(*pixel_rect(self.to_window_box(box)))
+            cr.clip()
+            # Clear to transparent, then draw
+            cr.set_operator(cairo.OPERATOR_CLEAR)
+            cr.paint()
+            cr.set_operator(cairo.OPERATOR_OVER)
+            self.apply_view(cr)
+            self.renderer.draw_graph(cr, box, self.scale)
+            cr.restore()
+        self.layerDamage = []
 
-    def draw_node(self, cr, (x, y), (r, g, b), number):
-        cr.save()
-        # Draw the circle
-        cr.set_source_rgb(r, g, b)
-        cr.arc(x, y, self.radius, 0, 2 * pi)
-        cr.fill()
-        # Draw the text
-        text = str(number)
-        cr.select_font_face('sans-serif', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
-        xbearing, ybearing, width, height, xadvance, yadvance = (
-                    cr.text_extents(text))
-        cr.set_font_size(self.textSize)
-        cr.set_source_rgb(1, 1, 1)
-        cr.move_to(x - xbearing - width/2, y - ybearing - height/2)
-        cr.show_text(text)
-        cr.restore()
+    def request_frame(self, width, height):
+        ''' Starts a full redraw of a snapshot of the graph on the
+        worker thread '''
+        self.frameNumber += 1
+        self.frameRequest = (width, height, self.view())
+        self.frameDamage = []
+        self.layerDamage = []
+        self.rasterizer.request(self.snapshots.snapshot(),
+                                width, height, self.frameNumber,
+                                self.view())
 
-    def draw_transition(self, cr, (fromX, fromY), (toX, toY)):
-        # == Math ==
-        # Get arc center & radius
-        vx, vy = get_vect(fromX, fromY, toX, toY)
-        cx, cy = get_offset_pt(fromX, fromY, vx, vy, self.arcSize)
-        radius = distance(cx, cy, fromX, fromY)
-        # Get starting & ending angles
-        v1 = get_vect(cx, cy, fromX, fromY)
-        v2 = get_vect(cx, cy, toX, toY)
-        angle1 = atan2(v1[1], v1[0])
-        angle2 = atan2(v2[1], v2[0])
-        # Get point where arc intersection the "to" node
-        ix, iy = get_circle_intersection(cx, cy, radius, \
-                                         toX, toY, self.radius)
-        # Get angle of the arc where it intersects the node
-        cix, ciy = get_vect(ix, iy, cx, cy)
-        intersectAngle = atan2(ciy, cix) + pi/2
-
-        # == Drawing ==
-        cr.save()
-        cr.set_source_rgb(0, 0, 0)
-        # Draw arc
-        cr.arc(cx, cy, radius, angle1, angle2)
-        cr.stroke()
-        # Draw arrow
-        self.draw_arrow(cr, ix, iy, intersectAngle)
-        cr.restore()
+    def cb_frame(self, number, surface):
+        ''' Called on the worker thread when a full redraw is done '''
+        gobject.idle_add(self.show_frame, number, surface)
 
-    def draw_arrow(self, cr, x, y, angle):
-        size = self.arrowLength
-        theta = self.arrowAngle
-        x1 = x + size * cos(angle + theta)
-        y1 = y + size * sin(angle + theta)
-        x2 = x + size * cos(angle - theta)
-        y2 = y + size * sin(angle - theta)
-        cr.move_to(x, y)
-        cr.line_to(x1, y1)
-        cr.stroke()
-        cr.move_to(x, y)
-        cr.line_to(x2, y2)
-        cr.stroke()
-
-    def draw_loop(self, cr, (x, y)):
-        r = self.radius
-        theta = 3*pi/8
-        dx, dy = r * cos(theta), -r * sin(theta)
-        startx, starty = x + dx, y + dy
-        end_dx, end_dy = -2 * dx, 0
-        cp1x, cp1y = 3 * dx, 3 * dy
-        cp2x, cp2y = -2 * dx - cp1x, cp1y
+    def show_frame(self, number, surface):
+        ''' Shows a finished full redraw, unless a newer one has been
+        asked for since '''
+        if number == self.frameNumber:
+            if self.frameDamage is None:
+                # The graph changed too much since its snapshot; leave
+                # the layer out of date so that a new one is asked for
+                self.layerDamage = None
+            else:
+                self.layer = surface
+                self.layerView = self.frameRequest[2]
+                # Bring it up to date with the edits made since its
+                # snapshot
+                self.layerDamage = self.frameDamage
+            self.frameRequest = None
+            self.frameDamage = None
+            self.queue_draw()
+        return False
 
+    def draw(self, cr, width, height):
+        ''' Draws everything directly, without the offscreen drawing '''
+        # Fill the background with white
+        cr.set_source_rgb(1, 1, 1)
+        cr.rectangle(0, 0, width, height)
+        cr.fill()
         cr.save()
-        cr.set_source_rgb(0, 0, 0)
-        cr.move_to(startx, starty)
-        cr.rel_curve_to(cp1x, cp1y, cp2x, cp2y, end_dx, end_dy)
-        cr.stroke()
-        self.draw_arrow(cr, startx, starty, -theta)
+        self.apply_view(cr)
+        self.draw_current_selection(cr)
+        self.renderer.draw_graph(cr, self.to_graph(0, 0) +
+                                 self.to_graph(width, height), self.scale)
         cr.restore()
 
-
-def get_vect(x1, y1, x2, y2):
-    ''' Returns the vector between the two points '''
-    return (x2 - x1), (y2 - y1)
-
-def get_offset_pt(x, y, vx, vy, scale):
-    ''' Calculates a point offset from a line '''
-    # 90 degree rotation & scale
-    x1, y1 = -vy * scale, vx * scale
-    # Midpoint of vector
-    x2, y2 = (vx * 0.5 + x), (vy * 0.5 + y)
-    # result
-    return (x1 + x2), (y1 + y2)
-
-def get_circle_intersection(x0, y0, r0, x1, y1, r1):
-    ''' Returns the first intersection of the circle at x0, y0 with
-    radius r0 and the circle at x1, y1 with radius r1'''
-    # Formule from http://local.wasp.uwa.edu.au/~pbourke/geometry/2circle/ 
-    d = hypot(x1 - x0, y1 - y0)
-    a = (r0**2 - r1**2 + d**2) / (2 * d)
-    h = sqrt(r0**2 - a**2)
-    x2 = x0 + (x1 - x0) * a/d
-    y2 = y0 + (y1 - y0) * a/d
-    x = x2 + (y1 - y0) * h/d
-    y = y2 - (x1 - x0) * h/d
-    return x, y
-    
+    def draw_current_selection(self, cr):
+        x, y = self.controller.getCurrentState().getPosition()
+        self.renderer.draw_selection(cr, x, y)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+import pygtk
+pygtk.require('2.0')
+import gtk, cairo
+from math import floor, ceil
+
+from Model import *
+from Geometry import *
+from Render import *
+
+class OverviewTracker(GraphWatcher):
+    ''' Collects the positions of the nodes whose look on an overview
+    of a graph (position and color) changed '''
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.points = []
+        graph.addWatcher(self)
+
+    def detach(self):
+        ''' Stops following the graph '''
+        self.graph.removeWatcher(self)
+
+    def take(self):
+        ''' Returns the positions changed since the last call '''
+        points = self.points
+        self.points = []
+        return points
+
+    def stateAdded(self, state):
+        self.points.append(state.getPosition())
+
+    def stateRemoved(self, state):
+        self.points.append(state.getPosition())
+        # Another state may have become the start state
+        if self.graph.states:
+            self.points.append(self.graph.states[0].getPosition())
+
+    def endChanged(self, state):
+        self.points.append(state.getPosition())
+
+    def stateMoved(self, state, oldPosition):
+        self.points.append(oldPosition)
+        self.points.append(state.getPosition())
+
+
+class MiniMap(gtk.DrawingArea):
+    ''' Shows the whole graph at a small size, with a rectangle around
+    the part shown in a GraphArea. Clicking or dragging on it moves the
+    GraphArea to show that part. '''
+    __gsignals__ = { "expose-event": "override" }
+
+    def __init__(self, controller, graphArea, size=200):
+        gtk.DrawingArea.__init__(self)
+        self.controller = controller
+        self.graphArea = graphArea
+        self.set_size_request(size, size)
+        # Room left around the graph, as a fraction of its size
+        self.margin = 0.1
+        self.renderer = graphArea.renderer.copy()
+        # Drawing of the nodes, the box of the graph it covers (None if
+        # it needs to be redrawn) and how it is placed on the map
+        self.cache = None
+        self.bounds = None
+        self.mapScale = 1.0
+        self.mapOffset = (0, 0)
+        self.tracker = OverviewTracker(controller.graph)
+        # Setup clicking on the map
+        self.add_events(gtk.gdk.BUTTON_PRESS_MASK | \
+                        gtk.gdk.BUTTON1_MOTION_MASK)
+        self.connect('button-press-event', self.cb_button)
+        self.connect('motion-notify-event', self.cb_button)
+        graphArea.connect('size-allocate', lambda *args: self.queue_draw())
+        graphArea.viewListeners.append(self.queue_draw)
+        controller.registerListener(self.update)
+
+    # ----------------------------------
+    # Functions for event handling
+    # ----------------------------------
+
+    def cb_button(self, event, data):
+        ''' Centers the graph area on the point clicked or dragged to '''
+        if self.bounds is None:
+            return
+        area = self.graphArea
+        gx, gy = self.to_graph(data.x, data.y)
+        width, height = area.allocation.width, area.allocation.height
+        area.set_view(area.scale, (gx - width / 2.0 / area.scale,
+                                   gy - height / 2.0 / area.scale))
+
+    # ----------------------------------
+    # Functions for updating
+    # ----------------------------------
+
+    def update(self):
+        ''' Redraws the nodes that changed on the cached drawing '''
+        graph = self.controller.graph
+        if self.tracker.graph is not graph:
+            # A different graph was loaded
+            self.tracker.detach()
+            self.tracker = OverviewTracker(graph)
+            self.bounds = None
+        points = self.tracker.take()
+        if self.bounds is not None and self.cache is not None:
+            x0, y0, x1, y1 = self.bounds
+            for (x, y) in points:
+                if not (x0 <= x <= x1 and y0 <= y <= y1):
+                    # The map has to be made larger
+                    self.bounds = None
+                    break
+                self.redraw_point(x, y)
+        self.queue_draw()
+
+    def to_graph(self, x, y):
+        ''' Converts a position on the map to graph coordinates '''
+        ox, oy = self.mapOffset
+        return ((x - ox) / self.mapScale, (y - oy) / self.mapScale)
+
+    def to_map(self, x, y):
+        ''' Converts graph coordinates to a position on the map '''
+        ox, oy = self.mapOffset
+        return (x * self.mapScale + ox, y * self.mapScale + oy)
+
+    def apply_map(self, cr):
+        ''' Makes cr draw in graph coordinates '''
+        cr.translate(*self.mapOffset)
+        cr.scale(self.mapScale, self.mapScale)
+
+    # ----------------------------------
+    # Functions for drawing
+    # ----------------------------------
+
+    def do_expose_event(self, event):
+        cr = self.window.cairo_create()
+        cr.region(event.region)
+        cr.clip()
+        self.render(cr, *self.window.get_size())
+
+    def render(self, cr, width, height):
+        ''' Draws the cached map with the current state and the part
+        shown in the graph area over it '''
+        if self.cache is None or self.bounds is None or \
+                self.cache.get_width() != width or \
+                self.cache.get_height() != height:
+            self.rebuild(width, height)
+        cr.set_source_surface(self.cache, 0, 0)
+        cr.paint()
+        # Current state
+        x, y = self.to_map(*self.controller.getCurrentState().getPosition())
+        cr.set_source_rgb(0.5, 0.5, 1.0)
+        cr.rectangle(x - 2, y - 2, 4, 4)
+        cr.fill()
+        # Part shown in the graph area
+        area = self.graphArea
+        x0, y0 = self.to_map(*area.to_graph(0, 0))
+        x1, y1 = self.to_map(*area.to_graph(area.allocation.width,
+                                            area.allocation.height))
+        cr.set_source_rgb(0.2, 0.2, 0.8)
+        cr.set_line_width(1)
+        cr.rectangle(floor(x0) + 0.5, floor(y0) + 0.5,
+                     ceil(x1 - x0), ceil(y1 - y0))
+        cr.stroke()
+
+    def rebuild(self, width, height):
+        ''' Fits the whole graph in the map again and redraws it '''
+        states = self.controller.graph.states
+        if states:
+            xs = [st.x for st in states]
+            ys = [st.y for st in states]
+            x0, y0, x1, y1 = min(xs), min(ys), max(xs), max(ys)
+        else:
+            x0, y0, x1, y1 = 0, 0, 0, 0
+        # Leave room for the graph to grow before it has to be rebuilt
+        pad = max(x1 - x0, y1 - y0, 100) * self.margin
+        self.bounds = (x0 - pad, y0 - pad, x1 + pad, y1 + pad)
+        boundsWidth = x1 - x0 + 2 * pad
+        boundsHeight = y1 - y0 + 2 * pad
+        self.mapScale = min(width / boundsWidth, height / boundsHeight)
+        self.mapOffset = (
+            (width - boundsWidth * self.mapScale) / 2 - self.bounds[0] *
+            self.mapScale,
+            (height - boundsHeight * self.mapScale) / 2 - self.bounds[1] *
+            self.mapScale)
+        if self.cache is None or self.cache.get_width() != width or \
+                self.cache.get_height() != height:
+            self.cache = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+        cr = cairo.Context(self.cache)
+        cr.set_source_rgb(1, 1, 1)
+        cr.paint()
+        self.apply_map(cr)
+        self.draw_nodes(cr, states)
+
+    def redraw_point(self, x, y):
+        ''' Redraws the part of the map around a point '''
+        r = self.renderer.radius
+        box = pixel_rect(self.to_map(x - r, y - r) +
+                         self.to_map(x + r, y + r))
+        cr = cairo.Context(self.cache)
+        cr.rectangle(*box)
+        cr.clip()
+        cr.set_source_rgb(1, 1, 1)
+        cr.paint()
+        # Find the nodes drawn there
+        left, top, width, height = box
+        gx0, gy0 = self.to_graph(left, top)
+        gx1, gy1 = self.to_graph(left + width, top + height)
+        nodes = self.controller.spatial.nodes.query(
+            (gx0 - r, gy0 - r, gx1 + r, gy1 + r))
+        self.apply_map(cr)
+        self.draw_nodes(cr, nodes)
+
+    def draw_nodes(self, cr, states):
+        ''' Draws nodes as plain circles, or as single pixels when they
+        would be smaller than that '''
+        nodes = ((st.x, st.y, nodeColor(st.index, st.end)) for st in states)
+        if self.mapScale < self.renderer.pixelScale:
+            self.renderer.draw_pixels(cr, self.mapScale, nodes)
+        else:
+            self.renderer.draw_dots(cr, nodes)
@@ -1,16 +1,29 @@
 #!/usr/bin/env python
 
+import os
+import re
 import json
-from Queue import Queue
+from collections import deque
 
-class State:
+class State(object):
     ''' This class represents a single state and its transitions '''
+    # Avoid a __dict__ per state; large games have millions of them
+    __slots__ = ('text', 'transitions', 'incoming', 'x', 'y', 'end',
+                 'index')
+
     def __init__(self, text, transitions=None, x=0, y=0, end=False):
         self.text = text
-        self.transitions = transitions if transitions else dict()
+        self.transitions = dict()
+        # Set of (state, command) pairs for transitions into this state
+        self.incoming = set()
+        if transitions:
+            for (command, state) in transitions.iteritems():
+                self.addTransition(command, state)
         self.x = x
         self.y = y
         self.end = end
+        # Position in the owning graph (maintained by Graph)
+        self.index = None
 
     def setText(self, text):
         ''' Sets the text, returning the previous value '''
@@ -32,7 +45,10 @@ class State:
     def addTransition(self, command, state):
         ''' Adds a transition to State object in state with the
         command text from command'''
+        if command in self.transitions:
+            self.removeTransition(command)
         self.transitions[command] = state
+        state.incoming.add( (self, command) )
 
     def getTransition(self, command):
         ''' Returns the transition taken from that command'''
@@ -42,17 +58,21 @@ class State:
         ''' Returns a list of all transition commands and states '''
         return [(k,v) for (k,v) in self.transitions.iteritems()]
 
+    def listIncoming(self):
+        ''' Returns a list of all (state, command) pairs for the
+        transitions leading into this state '''
+        return list(self.incoming)
+
     def removeTransition(self, command):
         ''' Removes a transition with the given command '''
-        del self.transitions[command]
+        state = self.transitions.pop(command)
+        state.incoming.discard( (self, command) )
 
     def removeConnections(self, state):
         ''' Removes all transition to a given state '''
-        toRemove = []
-        for cmd, s in self.transitions.iteritems():
-            if s == state: toRemove.append(cmd)
+        toRemove = [cmd for (s, cmd) in state.incoming if s is self]
         for cmd in toRemove:
-            del self.transitions[cmd]
+            self.removeTransition(cmd)
         return toRemove
                 
     def __str__(self):
@@ -61,29 +81,86 @@ class State:
             s += repr(k) + ": " + repr(v.text) + ", "
         return s + "}"
 
+class GraphWatcher:
+    ''' Base class for objects that follow the edits made to a
+    graph. Subclasses override the methods for the changes they care
+    about. '''
+
+    def stateAdded(self, state):
+        ''' Called after a state is added (or re-inserted) '''
+        pass
+
+    def stateRemoved(self, state):
+        ''' Called after a state is removed. Its transitions have
+        already been removed (and reported) by then. '''
+        pass
+
+    def transitionAdded(self, start, command, end):
+        ''' Called after a transition is added '''
+        pass
+
+    def transitionRemoved(self, start, command, end):
+        ''' Called after a transition is removed '''
+        pass
+
+    def endChanged(self, state):
+        ''' Called after a state is made or unmade an ending state '''
+        pass
+
+    def textChanged(self, state, oldText):
+        ''' Called after the text of a state is changed from oldText '''
+        pass
+
+    def stateMoved(self, state, oldPosition):
+        ''' Called after a state is moved from oldPosition '''
+        pass
+
 class Graph:
     ''' This class stores an entire transition graph made out of State
     objects.'''
     def __init__(self, serialized=None):
+        self.watchers = []
+        # Table of command labels, so that each label is stored once
+        self.labels = dict()
         if serialized:
             self._readSerialized(serialized)
         else:
             self.states = []
+        self.analysis = Analysis(self)
+        self.addWatcher(self.analysis)
+
+    def addWatcher(self, watcher):
+        ''' Registers a GraphWatcher to be told about edits '''
+        self.watchers.append(watcher)
+
+    def removeWatcher(self, watcher):
+        ''' Stops telling a GraphWatcher about edits '''
+        self.watchers.remove(watcher)
+
+    def _notify(self, event, *args):
+        ''' Calls the method named event on every watcher '''
+        for watcher in self.watchers:
+            getattr(watcher, event)(*args)
 
     def _readSerialized(self, serialized):
-        ''' Reads in the graph from a serialized format '''
+        ''' Reads in the graph from a serialized format (or any
+        iterable of serialized states, which is only read once) '''
         self.states = []
+        pending = []
 
         # Read in states with text and attirbutes
         for st in serialized:
             state = State(st['state'], None, st['x'], st['y'], st['end'])
+            state.index = len(self.states)
             self.states.append(state)
+            pending.append(st['transitions'])
 
         # Add transitions between states
-        for i,st in enumerate(serialized):
+        for i in xrange(len(pending)):
             start = self.states[i]
-            for (cmd,j) in st['transitions'].iteritems():
+            for (cmd,j) in pending[i].iteritems():
                 self.addTransition(start, self.states[j], cmd)
+            pending[i] = None
 
     def numStates(self):
         ''' Returns the number of states '''
@@ -93,17 +170,40 @@ class Graph:
         ''' Gets the state at the given index '''
         return self.states[index]
 
+    def getText(self, index):
+        ''' Gets the text of the state at the given index '''
+        return self.states[index].text
+
+    def numTransitions(self, index):
+        ''' Returns the number of transitions out of a state '''
+        return len(self.states[index].transitions)
+
     def getIndex(self, state):
         ''' Returns the index of the state '''
-        return self.states.index(state)
+        return state.index
 
     def addState(self, text='', x=0, y=0):
         ''' Adds a State object with the given text to the graph, and
         returns the new state object'''
         state = State(text, None, x, y, False)
+        state.index = len(self.states)
         self.states.append(state)
+        self._notify('stateAdded', state)
         return state
 
+    def insertState(self, index, state):
+        ''' Inserts a State object at the given index, shifting the
+        states after it (used to undo a removal) '''
+        self.states.insert(index, state)
+        self._renumber(index)
+        self._notify('stateAdded', state)
+
+    def _renumber(self, start):
+        ''' Updates the stored index of every state from start on '''
+        states = self.states
+        for i in xrange(start, len(states)):
+            states[i].index = i
+
     def removeState(self, index):
         ''' Removes a state by index from the graph.  Returns a
         history tuple of the format (index, 'removed',
@@ -112,33 +212,76 @@ class Graph:
         '''
         state = self.states[index]
         srlState = self.serializeState(index)
-        incoming = []
-        for (i, s) in enumerate(self.states):
-            if i == index: 
-                continue
-            commands = s.removeConnections(state)
-            for c in commands:
-                incoming.append( (i, c) )
+        # Only the neighbors of the state need to be updated
+        incoming = [(s.index, cmd) for (s, cmd) in state.incoming
+                    if s is not state]
+        incoming.sort()
+        for (i, cmd) in incoming:
+            self._removeTransition(self.states[i], cmd)
+        for cmd in state.transitions.keys():
+            self._removeTransition(state, cmd)
         self.states.pop(index)
+        state.index = None
+        self._renumber(index)
+        self._notify('stateRemoved', state)
         return (index, 'removed', srlState, incoming)
             
 
     def addTransition(self, start, end, command):
         ''' Adds a transition from the start state to the end state on
         the given command '''
+        command = self.labels.setdefault(command, command)
+        if command in start.transitions:
+            self._removeTransition(start, command)
         start.addTransition(command, end)
-        
+        self._notify('transitionAdded', start, command, end)
+
+    def _removeTransition(self, start, command):
+        ''' Removes a transition from the start state object, and
+        returns the state it led to '''
+        end = start.getTransition(command)
+        start.removeTransition(command)
+        self._notify('transitionRemoved', start, command, end)
+        return end
+
     def removeTransition(self, startNo, command):
         ''' Removes a transition starting at start with the given
         command'''
         start = self.getState(startNo)
         to = start.getTransition(command)
         if to:
-            start.removeTransition(command)
+            self._removeTransition(start, command)
             toind = self.getIndex(to)
             return (startNo, 'rmtr', command, toind)
         return None
 
+    def setEnd(self, stateNo, end):
+        ''' Sets whether a state is an ending state, returning the
+        previous value '''
+        state = self.states[stateNo]
+        old = state.end
+        state.end = end
+        if old != end:
+            self._notify('endChanged', state)
+        return old
+
+    def setText(self, stateNo, text):
+        ''' Sets the text of a state, returning the previous text '''
+        state = self.states[stateNo]
+        old = state.setText(text)
+        if old != text:
+            self._notify('textChanged', state, old)
+        return old
+
+    def moveState(self, stateNo, x, y):
+        ''' Sets the position of a state, returning the previous
+        position '''
+        state = self.states[stateNo]
+        old = state.setPosition(x, y)
+        if old != (x, y):
+            self._notify('stateMoved', state, old)
+        return old
+
     def toSerializable(self):
         ''' Converts graph into a format that can be serialized into
         JSON'''
@@ -161,36 +304,58 @@ class Graph:
 
     def getUnreachable(self):
         ''' Returns a list of any unreachable states '''
-        # Perform a breadth-first search
-        reached = set()
-        queue = Queue()
-        start = self.states[0]
-        queue.put(start)
-        reached.add(start)
-        while not queue.empty():
-            state = queue.get()
-            for (_, st) in state.listTransitions():
-                if not st in reached:
-                    reached.add(st)
-                    queue.put(st)
-        return self.listNotIncluded(reached)
+        return self.listNotIncluded(self.analysis.getReachable())
+
+    def countUnreachable(self):
+        ''' Returns the number of unreachable states '''
+        return self.analysis.countUnreachable()
 
     def getInescapable(self):
         ''' Returns a list of inescapable states (those from which an
         ending state cannot be reached) '''
-        reachEnd = set(st for st in self.states if st.end)
-        updated = True
-        while updated:
-            updated = False
-            for state in self.states:
-                if state in reachEnd:
-                    continue
-                for (_, st) in state.listTransitions():
-                    if st in reachEnd:
-                        reachEnd.add(state)
-                        updated = True
-                        break
-        return self.listNotIncluded(reachEnd)
+        return self.listNotIncluded(self.analysis.getEscapable())
+
+    def findReachable(self):
+        ''' Searches for the states reachable from the start state.
+        Returns a dict mapping each of them to the (state, command)
+        transition it was first reached by. '''
+        # Perform a breadth-first search
+        start = self.states[0]
+        return searchForward({start: None}, [start])
+
+    def findEscapable(self):
+        ''' Searches for the states from which an ending state can be
+        reached. Returns a dict mapping each of them to the (state,
+        command) transition that leads it towards an ending state. '''
+        # Search backwards from the ending states
+        reachEnd = dict((st, None) for st in self.states if st.end)
+        return searchBackward(reachEnd, reachEnd.keys())
+
+    def getEquivalentStates(self, byText=False):
+        ''' Returns a list of the classes of states that behave the
+        same way (see findEquivalentStates) '''
+        return findEquivalentStates(self, byText)
+
+    def minimized(self, byText=False):
+        ''' Returns a new graph with each class of equivalent states
+        merged into one state. The merged state takes its text and
+        position from the first state in its class. '''
+        classes = self.getEquivalentStates(byText)
+        classOf = dict()
+        for (n, members) in enumerate(classes):
+            for i in members:
+                classOf[i] = n
+        graph = Graph()
+        for members in classes:
+            st = self.states[members[0]]
+            graph.addState(st.text, st.x, st.y)
+            graph.setEnd(graph.numStates() - 1, st.end)
+        for (n, members) in enumerate(classes):
+            start = graph.getState(n)
+            for (cmd, to) in self.states[members[0]].transitions.iteritems():
+                graph.addTransition(start, graph.getState(classOf[to.index]),
+                                    cmd)
+        return graph
 
     def listNotIncluded(self, states):
         ''' Takes a set of states and returns a list of the indcies of
@@ -202,13 +367,347 @@ class Graph:
         return unreached
         
 
+def searchForward(reached, frontier):
+    ''' Adds to the dict reached every state that can be reached from
+    a state in frontier by following transitions, mapped to the
+    (state, command) transition it was reached by. Returns reached. '''
+    queue = deque(frontier)
+    while queue:
+        state = queue.popleft()
+        for (cmd, st) in state.transitions.iteritems():
+            if not st in reached:
+                reached[st] = (state, cmd)
+                queue.append(st)
+    return reached
+
+def searchBackward(reached, frontier):
+    ''' Adds to the dict reached every state that can reach a state in
+    frontier by following transitions, mapped to the (state, command)
+    transition it takes towards frontier. Returns reached. '''
+    queue = deque(frontier)
+    while queue:
+        state = queue.popleft()
+        for (st, cmd) in state.incoming:
+            if not st in reached:
+                reached[st] = (state, cmd)
+                queue.append(st)
+    return reached
+
+class Analysis(GraphWatcher):
+    ''' Keeps the states reachable from the start state and the states
+    that can reach an ending state up to date as the graph is edited.
+
+    Each state in either set remembers the transition that put it
+    there, so together they form a search tree. Additions only extend
+    the sets, so they are applied directly. Removing a transition that
+    is not in a tree changes nothing. When one that is gets removed,
+    another transition that does not depend on the lost one is looked
+    for. If there is none, the part of the tree that hung off the lost
+    transition is taken out and searched for again from the rest. Only
+    removing the start state makes the reachable states be searched
+    for again from scratch. '''
+
+    def __init__(self, graph):
+        self.graph = graph
+        # None means the set needs to be searched for again
+        self.reachable = None
+        self.escapable = None
+
+    def getReachable(self):
+        ''' Returns the states reachable from the start, as a dict
+        (see Graph.findReachable) '''
+        if self.reachable is None:
+            self.reachable = self.graph.findReachable()
+        return self.reachable
+
+    def getEscapable(self):
+        ''' Returns the states that can reach an ending state, as a
+        dict (see Graph.findEscapable) '''
+        if self.escapable is None:
+            self.escapable = self.graph.findEscapable()
+        return self.escapable
+
+    def countUnreachable(self):
+        ''' Returns the number of unreachable states '''
+        return self.graph.numStates() - len(self.getReachable())
+
+    def stateAdded(self, state):
+        if state.index == 0:
+            self.reachable = None
+        if state.end and self.escapable is not None:
+            self.escapable[state] = None
+
+    def stateRemoved(self, state):
+        # Its transitions were removed first, which handles the rest,
+        # unless it was the start state (the only one with no link)
+        if self.reachable is not None:
+            if self.reachable.get(state, 0) is None:
+                self.reachable = None
+            else:
+                self.reachable.pop(state, None)
+        if self.escapable is not None:
+            self.escapable.pop(state, None)
+
+    def transitionAdded(self, start, command, end):
+        reachable = self.reachable
+        if reachable is not None:
+            if start in reachable and end not in reachable:
+                reachable[end] = (start, command)
+                searchForward(reachable, [end])
+        escapable = self.escapable
+        if escapable is not None:
+            if end in escapable and start not in escapable:
+                escapable[start] = (end, command)
+                searchBackward(escapable, [start])
+
+    def transitionRemoved(self, start, command, end):
+        reachable = self.reachable
+        if reachable is not None:
+            if reachable.get(end) == (start, command):
+                if not repairLink(reachable, end, end.incoming):
+                    regrow(reachable, linkedThrough(reachable, end, outgoing),
+                           incoming, searchForward)
+        escapable = self.escapable
+        if escapable is not None:
+            if escapable.get(start) == (end, command):
+                if not repairLink(escapable, start, outgoing(start)):
+                    regrow(escapable,
+                           linkedThrough(escapable, start, incoming),
+                           outgoing, searchBackward)
+
+    def endChanged(self, state):
+        escapable = self.escapable
+        if escapable is None:
+            return
+        if state.end:
+            escapable[state] = None
+            searchBackward(escapable, [state])
+        elif escapable.get(state, 0) is None:
+            if not repairLink(escapable, state, outgoing(state)):
+                regrow(escapable, linkedThrough(escapable, state, incoming),
+                       outgoing, searchBackward)
+
+def outgoing(state):
+    ''' Returns the transitions out of a state as (state, command)
+    pairs, the same shape as State.incoming '''
+    return [(st, cmd) for (cmd, st) in state.transitions.iteritems()]
+
+def incoming(state):
+    ''' Returns the transitions into a state as (state, command) pairs '''
+    return state.incoming
+
+def dependsOn(found, state, other):
+    ''' Returns True if the chain of links in found starting from
+    state passes through other '''
+    while state is not None:
+        if state is other:
+            return True
+        link = found[state]
+        state = link[0] if link else None
+    return False
+
+def repairLink(found, state, candidates):
+    ''' Replaces the link of state in found with one of the candidate
+    (state, command) pairs whose chain does not pass back through
+    state. Returns False if there is no such candidate. '''
+    for (other, cmd) in candidates:
+        if other in found and not dependsOn(found, other, state):
+            found[state] = (other, cmd)
+            return True
+    return False
+
+def linkedThrough(found, state, neighbors):
+    ''' Returns the states in found whose chain of links passes through
+    state, starting with state. neighbors gives the (state, command)
+    pairs of the states that may be linked to a state. '''
+    tree = [state]
+    for st in tree:
+        for (other, cmd) in neighbors(st):
+            if found.get(other) == (st, cmd):
+                tree.append(other)
+    return tree
+
+def regrow(found, tree, candidates, search):
+    ''' Takes the states of tree out of found, then links back the ones
+    that have a candidate (state, command) pair still in found and
+    searches on from them with search '''
+    for st in tree:
+        del found[st]
+    frontier = []
+    for st in tree:
+        for (other, cmd) in candidates(st):
+            if other in found:
+                found[st] = (other, cmd)
+                frontier.append(st)
+                break
+    search(found, frontier)
+
+def findEquivalentStates(graph, byText=False):
+    ''' Finds the classes of equivalent states in a graph: states with
+    the same end flag and the same commands, which lead to equivalent
+    states. If byText is True, states must also have the same text.
+    Uses Hopcroft's partition refinement. Returns a list of classes,
+    each a sorted list of state indices, ordered by their first
+    index. '''
+    states = graph.states
+    n = len(states)
+    labelIds = dict()
+    # preds[t][c] lists the states with a transition to t on command c
+    preds = [dict() for _ in xrange(n)]
+    # Initial partition: by end flag, commands and (maybe) text
+    keys = dict()
+    members = []
+    blockOf = [0] * n
+    for (i, st) in enumerate(states):
+        commands = []
+        for (cmd, to) in st.transitions.iteritems():
+            c = labelIds.setdefault(cmd, len(labelIds))
+            commands.append(c)
+            preds[to.index].setdefault(c, []).append(i)
+        key = (st.end, tuple(sorted(commands)))
+        if byText:
+            key += (st.text,)
+        if key not in keys:
+            keys[key] = len(members)
+            members.append(set())
+        b = keys[key]
+        members[b].add(i)
+        blockOf[i] = b
+
+    # Split blocks until no block has states that go to different
+    # blocks on the same command
+    work = range(len(members))
+    while work:
+        splitter = work.pop()
+        bySymbol = dict()
+        for t in list(members[splitter]):
+            for (c, sources) in preds[t].iteritems():
+                bySymbol.setdefault(c, []).extend(sources)
+        for sources in bySymbol.itervalues():
+            # Group the sources by the block they are in
+            marked = dict()
+            for i in sources:
+                marked.setdefault(blockOf[i], set()).add(i)
+            for (b, inside) in marked.iteritems():
+                block = members[b]
+                if len(inside) == len(block):
+                    continue
+                # Move the smaller half to a new block. Since it is the
+                # smaller half, the new block is always the one to add
+                # to the work list.
+                if 2 * len(inside) <= len(block):
+                    smaller = inside
+                else:
+                    smaller = block - inside
+                block -= smaller
+                new = len(members)
+                members.append(smaller)
+                for i in smaller:
+                    blockOf[i] = new
+                work.append(new)
+
+    classes = [sorted(block) for block in members]
+    classes.sort()
+    return classes
+
+def checkGraph(graph):
+    ''' Looks for mistakes in a game. Works on any graph with the
+    index-based methods of Graph (such as a CompactGraph). Returns a
+    list of problems and a list of warnings. '''
+    problems = []
+    warnings = []
+
+    # Check for states with no text
+    for i in xrange(graph.numStates()):
+        if not graph.getText(i).strip():
+            warnings.append('State #%d has no text.' % i)
+
+    # Ensure there are ending states
+    endingStates = graph.getEndingStates()
+    if not endingStates:
+        problems.append('There are no ending states.')
+
+    # Check for transitions out of ending states
+    for i in endingStates:
+        if graph.numTransitions(i):
+            problems.append(
+                'End state #%d has exiting transitions.' % i)
+
+    # Check for unreachable states
+    if graph.countUnreachable():
+        problems.append('There are unreachable states.')
+
+    # Check for states that cannot reach an ending state
+    inescapable = graph.getInescapable()
+    for i in inescapable:
+        problems.append('State #%d cannot reach an end state.' % i)
+
+    return problems, warnings
+
 def saveGraph(graph, filename):
     ''' Saves the graph to the given file name '''
     with open(filename, 'w') as outf:
         json.dump(graph.toSerializable(), outf, indent=4)
 
-def loadGraph(filename):
-    ''' Loads a graph from a file '''
+def loadGraph(filename, progress=None):
+    ''' Loads a graph from a file. If given, progress is called with
+    the number of bytes read so far and the size of the file. '''
     with open(filename) as inf:
-        j = json.load(inf)
-    return Graph(serialized=j)
+        return Graph(serialized=iterSerialized(inf, progress))
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+def iterSerialized(inf, progress=None, chunkSize=1 << 16):
+    ''' Reads the serialized list of states from a file one state at a
+    time, so the whole list is never in memory at once. If given,
+    progress is called with the number of bytes read so far and the
+    size of the file after each state. '''
+    decoder = json.JSONDecoder()
+    total = os.fstat(inf.fileno()).st_size
+    # Bytes dropped from the front of buf
+    offset = 0
+    buf, pos = '', 0
+    readSize = chunkSize
+    eof = False
+    expect = '['
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
+                raise ValueError('Unexpected end of file')
+        elif expect == '[':
+            if buf[pos] != '[':
+                raise ValueError('Expected a list of states')
+            pos += 1
+            expect = 'first'
+            continue
+        elif expect != 'state' and buf[pos] == ']':
+            return
+        elif expect == 'next':
+            if buf[pos] != ',':
+                raise ValueError('Expected , or ] at byte %d' %
+                                 (offset + pos))
+            pos += 1
+            expect = 'state'
+            continue
+        else:
+            try:
+                state, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Incomplete state: read more unless there is no more
+                if eof:
+                    raise
+            else:
+                expect = 'next'
+                readSize = chunkSize
+                if progress:
+                    progress(offset + pos, total)
+                yield state
+                continue
+            # Read bigger chunks while one state does not fit
+            readSize = max(readSize, len(buf) - pos)
+        # Drop what has been parsed and read more
+        chunk = inf.read(readSize)
+        eof = not chunk
+        offset += pos
+        buf, pos = buf[pos:] + chunk, 0
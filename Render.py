@@ -0,0 +1,617 @@
+#!/usr/bin/env python
+
+''' Draws a graph onto any cairo context. This does not need gtk, so it
+can also be used to draw games to files. '''
+
+import cairo
+import threading
+from array import array
+from itertools import izip
+from math import pi, sqrt, hypot, cos, sin, atan2, floor, ceil
+
+from Model import *
+from Geometry import *
+
+class EdgeCache(GraphWatcher):
+    ''' Remembers how to draw each transition, keyed by the positions
+    of its ends. An entry is dropped when one of its ends is moved or
+    the transition is removed. '''
+
+    def __init__(self, graph, compute):
+        self.graph = graph
+        self.compute = compute
+        self.entries = dict()
+        graph.addWatcher(self)
+
+    def detach(self):
+        ''' Stops following the graph '''
+        self.graph.removeWatcher(self)
+
+    def get(self, fromXY, toXY):
+        ''' Returns the geometry of a transition between two points '''
+        key = (fromXY, toXY)
+        geometry = self.entries.get(key)
+        if geometry is None:
+            geometry = self.entries[key] = self.compute(fromXY, toXY)
+        return geometry
+
+    def clear(self):
+        self.entries.clear()
+
+    def transitionRemoved(self, start, command, end):
+        self.entries.pop((start.getPosition(), end.getPosition()), None)
+
+    def stateMoved(self, state, oldPosition):
+        entries = self.entries
+        for end in state.transitions.itervalues():
+            entries.pop((oldPosition, end.getPosition()), None)
+        for (start, _) in state.incoming:
+            entries.pop((start.getPosition(), oldPosition), None)
+
+
+# Names of the settings of a Renderer
+SETTINGS = ('radius', 'arcSize', 'arrowLength', 'arrowAngle', 'textSize',
+            'detailScale', 'pixelScale')
+
+GREEN = (0, 0.8, 0)
+RED   = (1, 0, 0)
+BLACK = (0, 0, 0)
+
+def nodeColor(index, end):
+    ''' Returns the color of a node: green for the start state, red for
+    ending states and black for the rest '''
+    if index == 0:
+        return GREEN
+    elif end:
+        return RED
+    return BLACK
+
+class Renderer:
+    ''' Draws the nodes and transitions of a graph. If a GraphIndex is
+    given, drawing part of the graph only visits what is in that part.
+    Without a graph, it can only draw Snapshots with draw_snapshot.
+    '''
+
+    def __init__(self, graph=None, spatial=None):
+        # Settings
+        self.radius = RADIUS
+        self.arcSize = ARC_SIZE
+        self.arrowLength = ARROW_LENGTH
+        self.arrowAngle = pi/6
+        self.textSize = 10
+        # Below this zoom, labels, arrowheads and self-loops are left
+        # out, and each pair of connected nodes gets one straight line
+        self.detailScale = 0.5
+        # Below this zoom, nodes are single pixels and transitions are
+        # left out
+        self.pixelScale = 0.15
+        # The text of each node number and where to start it from the
+        # node's center, measured at labelSize
+        self.labels = dict()
+        self.labelSize = None
+        self.graph = None
+        self.spatial = None
+        if graph is not None:
+            self.setGraph(graph, spatial)
+
+    def setGraph(self, graph, spatial=None):
+        ''' Switches to drawing another graph '''
+        self.detach()
+        self.graph = graph
+        self.spatial = spatial
+        # Remember how to draw each transition
+        self.edgeCache = EdgeCache(graph, self.edge_geometry)
+
+    def detach(self):
+        ''' Stops following the graph '''
+        if self.graph is not None:
+            self.edgeCache.detach()
+
+    def copy(self):
+        ''' Returns a Renderer with the same settings and no graph '''
+        other = Renderer()
+        for name in SETTINGS:
+            setattr(other, name, getattr(self, name))
+        return other
+
+    def bounds(self):
+        ''' Returns the box (x0, y0, x1, y1) around the whole drawing,
+        or None for an empty graph '''
+        boxes = []
+        for state in self.graph.states:
+            x, y = state.getPosition()
+            boxes.append(node_bounds(x, y, self.radius))
+            for end in state.transitions.itervalues():
+                if end is not state:
+                    boxes.append(edge_bounds((x, y), end.getPosition(),
+                                             self.arcSize,
+                                             self.arrowLength))
+        if not boxes:
+            return None
+        return bounding_box(boxes)
+
+    def draw(self, cr, width, height, box=None, selected=None):
+        ''' Draws the graph on a white background, with the state
+        selected (if any) highlighted '''
+        # Fill the background with white
+        cr.set_source_rgb(1, 1, 1)
+        cr.rectangle(0, 0, width, height)
+        cr.fill()
+        if selected is not None:
+            x, y = selected.getPosition()
+            self.draw_selection(cr, x, y)
+        self.draw_graph(cr, box)
+
+    def draw_graph(self, cr, box=None, scale=1.0):
+        ''' Draws the transitions and nodes of the graph. If box is
+        given, only the ones that reach into it are drawn. The less
+        scale (the zoom of cr) is, the less detail is drawn. '''
+        cr.set_line_width(1)
+
+        # Find what needs drawing
+        whole = box is None or self.spatial is None
+        if whole:
+            states = self.graph.states
+        elif scale < self.pixelScale:
+            # Pixels don't overlap, so the order doesn't matter
+            states = self.spatial.nodes.query(box)
+        else:
+            states = self.spatial.nodesIn(box)
+
+        if scale < self.pixelScale:
+            self.draw_pixels(cr, scale, ((st.x, st.y,
+                                          nodeColor(st.index, st.end))
+                                         for st in states))
+            return
+
+        if whole:
+            edges = ((st, cmd) for st in states for cmd in st.transitions)
+        else:
+            edges = self.spatial.edgesIn(box)
+        if scale < self.detailScale:
+            # One line for each pair of connected nodes
+            pairs = set()
+            for (start, cmd) in edges:
+                end = start.transitions[cmd]
+                if start.index < end.index:
+                    pairs.add((start, end))
+                elif end.index < start.index:
+                    pairs.add((end, start))
+            self.draw_lines(cr, scale, ((a.x, a.y, b.x, b.y)
+                                        for (a, b) in pairs))
+            self.draw_dots(cr, ((st.x, st.y, nodeColor(st.index, st.end))
+                                for st in states))
+            return
+
+        # Draw transitions, all in one path
+        cr.set_source_rgb(*BLACK)
+        for (fromState, cmd) in edges:
+            toState = fromState.transitions[cmd]
+            fromXY = fromState.getPosition()
+            if toState is fromState:
+                self.draw_loop(cr, fromXY)
+            else:
+                self.draw_transition(cr, fromXY, toState.getPosition())
+        cr.stroke()
+
+        # Draw vertices
+        self.set_label_font(cr)
+        for state in states:
+            i = state.index
+            self.draw_node(cr, state.getPosition(),
+                           nodeColor(i, state.end), i)
+
+    def draw_snapshot(self, cr, snapshot, scale=1.0, box=None):
+        ''' Draws a Snapshot, the same way as draw_graph. If box is
+        given, only the nodes and transitions that reach into it are
+        drawn. '''
+        cr.set_line_width(1)
+        xs, ys, ends = snapshot.xs, snapshot.ys, snapshot.ends
+        numbers = snapshot.numbers
+        starts, targets = snapshot.starts, snapshot.targets
+        if box is None:
+            x0 = y0 = float('-inf')
+            x1 = y1 = float('inf')
+        else:
+            x0, y0, x1, y1 = box
+        # Nodes in order of their numbers, as draw_graph draws them
+        reach = self.radius * NODE_REACH
+        slots = [i for i in xrange(len(numbers)) if numbers[i] >= 0 and
+                 x0 - reach <= xs[i] <= x1 + reach and
+                 y0 - reach <= ys[i] <= y1 + reach]
+        slots.sort(key=numbers.__getitem__)
+        nodes = ((xs[i], ys[i], nodeColor(numbers[i], ends[i]))
+                 for i in slots)
+
+        if scale < self.pixelScale:
+            self.draw_pixels(cr, scale, nodes)
+            return
+        if scale < self.detailScale:
+            # One line for each pair of connected nodes, straight
+            # between them
+            bulge, margin = 0, 1.0 / scale
+        else:
+            # Arcs stay within the circle they are part of, whose
+            # center is arcSize times their length from their middle
+            bulge = self.arcSize + sqrt(0.25 + self.arcSize**2)
+            margin = self.arrowLength
+        edges = []
+        for (i, j) in izip(starts, targets):
+            if i < 0:
+                continue
+            ax, bx = xs[i], xs[j]
+            if ax > bx:
+                ax, bx = bx, ax
+            ay, by = ys[i], ys[j]
+            if ay > by:
+                ay, by = by, ay
+            # Self-loops are drawn as part of the node
+            grow = reach if i == j else (bx - ax + by - ay) * bulge + margin
+            if ax - grow <= x1 and x0 <= bx + grow and \
+                    ay - grow <= y1 and y0 <= by + grow:
+                edges.append((i, j))
+        if scale < self.detailScale:
+            pairs = set((min(i, j), max(i, j)) for (i, j) in edges
+                        if i != j)
+            self.draw_lines(cr, scale, ((xs[i], ys[i], xs[j], ys[j])
+                                        for (i, j) in pairs))
+            self.draw_dots(cr, nodes)
+            return
+
+        # Draw transitions, all in one path
+        cr.set_source_rgb(*BLACK)
+        for (i, j) in edges:
+            fromXY = (xs[i], ys[i])
+            if j == i:
+                self.draw_loop(cr, fromXY)
+            else:
+                toXY = (xs[j], ys[j])
+                self.draw_edge(cr, self.edge_geometry(fromXY, toXY))
+        cr.stroke()
+
+        # Draw vertices
+        self.set_label_font(cr)
+        for i in slots:
+            self.draw_node(cr, (xs[i], ys[i]),
+                           nodeColor(numbers[i], ends[i]), numbers[i])
+
+    def draw_lines(self, cr, scale, lines):
+        ''' Draws (x0, y0, x1, y1) lines a pixel wide in one path '''
+        cr.set_line_width(1.0 / scale)
+        cr.set_source_rgb(*BLACK)
+        for (x0, y0, x1, y1) in lines:
+            cr.move_to(x0, y0)
+            cr.line_to(x1, y1)
+        cr.stroke()
+
+    def draw_dots(self, cr, nodes):
+        ''' Draws (x, y, color) nodes as plain circles, filling all the
+        ones of each color at once '''
+        byColor = dict()
+        for (x, y, color) in nodes:
+            byColor.setdefault(color, []).append((x, y))
+        r = self.radius
+        for (color, points) in byColor.iteritems():
+            cr.set_source_rgb(*color)
+            for (x, y) in points:
+                cr.new_sub_path()
+                cr.arc(x, y, r, 0, 2 * pi)
+            cr.fill()
+
+    def draw_pixels(self, cr, scale, nodes):
+        ''' Draws (x, y, color) nodes as single pixels. The pixels of
+        each color are set in an array over the area being drawn, which
+        is then used as a mask. cr must not be rotated or skewed. '''
+        x0, y0, x1, y1 = cr.clip_extents()
+        # Where the graph's origin and the area are on the surface
+        ox, oy = cr.user_to_device(0, 0)
+        left = int(floor(ox + x0 * scale))
+        top = int(floor(oy + y0 * scale))
+        width = int(ceil(ox + x1 * scale)) - left
+        height = int(ceil(oy + y1 * scale)) - top
+        if width <= 0 or height <= 0:
+            return
+        stride = (width + 3) & ~3
+        masks = dict()
+        for (x, y, color) in nodes:
+            px = int(ox + x * scale) - left
+            py = int(oy + y * scale) - top
+            if 0 <= px < width and 0 <= py < height:
+                mask = masks.get(color)
+                if mask is None:
+                    mask = masks[color] = array('B', [0]) * (stride * height)
+                mask[py * stride + px] = 255
+        cr.save()
+        cr.identity_matrix()
+        # Black first, so the start and ending states show on top
+        for color in sorted(masks, key=lambda c: c != BLACK):
+            mask = masks[color]
+            surface = cairo.ImageSurface.create_for_data(
+                mask, cairo.FORMAT_A8, width, height, stride)
+            cr.set_source_rgb(*color)
+            cr.mask_surface(surface, left, top)
+        cr.restore()
+
+    def draw_selection(self, cr, x, y):
+        cr.save()
+        cr.set_source_rgb(0.8, 0.8, 1.0)
+        cr.arc(x, y, self.radius + 4, 0, 2*pi)
+        cr.fill()
+        cr.restore()
+
+    def draw_drag(self, cr, (x, y)):
+        ''' Draws an outline where a dragged node would be dropped '''
+        cr.save()
+        cr.set_source_rgb(0.5, 0.5, 0.5)
+        cr.set_line_width(1)
+        cr.arc(x, y, self.radius, 0, 2 * pi)
+        cr.stroke()
+        cr.restore()
+
+    def set_label_font(self, cr):
+        ''' Sets up the font for the numbers on the nodes. Call this
+        before draw_node. '''
+        cr.select_font_face('sans-serif', cairo.FONT_SLANT_NORMAL,
+                            cairo.FONT_WEIGHT_BOLD)
+        cr.set_font_size(self.textSize)
+        if self.labelSize != self.textSize:
+            self.labels.clear()
+            self.labelSize = self.textSize
+
+    def node_label(self, cr, number):
+        ''' Returns the text for a node number, and where to start it
+        so that it is centered on the node, relative to the center '''
+        label = self.labels.get(number)
+        if label is None:
+            text = str(number)
+            xbearing, ybearing, width, height, xadvance, yadvance = (
+                        cr.text_extents(text))
+            label = (text, -xbearing - width/2, -ybearing - height/2)
+            self.labels[number] = label
+        return label
+
+    def draw_node(self, cr, (x, y), (r, g, b), number):
+        # Draw the circle
+        cr.set_source_rgb(r, g, b)
+        cr.arc(x, y, self.radius, 0, 2 * pi)
+        cr.fill()
+        # Draw the text
+        text, dx, dy = self.node_label(cr, number)
+        cr.set_source_rgb(1, 1, 1)
+        cr.move_to(x + dx, y + dy)
+        cr.show_text(text)
+
+    def edge_geometry(self, (fromX, fromY), (toX, toY)):
+        ''' Works out how to draw a transition between two points.
+        Returns the arc center, radius and start and end angles, and
+        the point of the arrow and the ends of its two lines. '''
+        # Get arc center & radius
+        vx, vy = get_vect(fromX, fromY, toX, toY)
+        cx, cy = get_offset_pt(fromX, fromY, vx, vy, self.arcSize)
+        radius = distance(cx, cy, fromX, fromY)
+        # Get starting & ending angles
+        v1 = get_vect(cx, cy, fromX, fromY)
+        v2 = get_vect(cx, cy, toX, toY)
+        angle1 = atan2(v1[1], v1[0])
+        angle2 = atan2(v2[1], v2[0])
+        # Get point where arc intersection the "to" node
+        ix, iy = get_circle_intersection(cx, cy, radius, \
+                                         toX, toY, self.radius)
+        # Get angle of the arc where it intersects the node
+        cix, ciy = get_vect(ix, iy, cx, cy)
+        intersectAngle = atan2(ciy, cix) + pi/2
+        arrow = self.arrow_points(ix, iy, intersectAngle)
+        return (cx, cy, radius, angle1, angle2, arrow)
+
+    def draw_transition(self, cr, fromXY, toXY):
+        ''' Adds a transition to the current path; stroke it after '''
+        self.draw_edge(cr, self.edgeCache.get(fromXY, toXY))
+
+    def draw_edge(self, cr, (cx, cy, radius, angle1, angle2, arrow)):
+        ''' Adds a transition from its edge_geometry to the path '''
+        # Draw arc
+        cr.new_sub_path()
+        cr.arc(cx, cy, radius, angle1, angle2)
+        # Draw arrow
+        self.draw_arrow(cr, arrow)
+
+    def arrow_points(self, x, y, angle):
+        ''' Returns the point and the ends of the two lines of an
+        arrow at x, y pointing along angle '''
+        size = self.arrowLength
+        theta = self.arrowAngle
+        x1 = x + size * cos(angle + theta)
+        y1 = y + size * sin(angle + theta)
+        x2 = x + size * cos(angle - theta)
+        y2 = y + size * sin(angle - theta)
+        return (x, y, x1, y1, x2, y2)
+
+    def draw_arrow(self, cr, (x, y, x1, y1, x2, y2)):
+        cr.move_to(x, y)
+        cr.line_to(x1, y1)
+        cr.move_to(x, y)
+        cr.line_to(x2, y2)
+
+    def draw_loop(self, cr, (x, y)):
+        ''' Adds a self-loop to the current path; stroke it after '''
+        r = self.radius
+        theta = 3*pi/8
+        dx, dy = r * cos(theta), -r * sin(theta)
+        startx, starty = x + dx, y + dy
+        end_dx, end_dy = -2 * dx, 0
+        cp1x, cp1y = 3 * dx, 3 * dy
+        cp2x, cp2y = -2 * dx - cp1x, cp1y
+
+        cr.move_to(startx, starty)
+        cr.rel_curve_to(cp1x, cp1y, cp2x, cp2y, end_dx, end_dy)
+        self.draw_arrow(cr, self.arrow_points(startx, starty, -theta))
+
+
+class Snapshot:
+    ''' A copy of the nodes and transitions of a graph that can be
+    drawn while the graph is edited. Nodes are kept in slots, with
+    their position, whether they are ending states and their number
+    (-1 for an unused slot). Transitions are kept as the slots of their
+    start and end nodes (a start of -1 for an unused slot). '''
+
+    def __init__(self, xs, ys, ends, numbers, starts, targets):
+        self.xs = xs
+        self.ys = ys
+        self.ends = ends
+        self.numbers = numbers
+        self.starts = starts
+        self.targets = targets
+
+
+class SnapshotTracker(GraphWatcher):
+    ''' Keeps the arrays of a Snapshot of a graph up to date as it is
+    edited, so that taking a snapshot only copies them. A removed node
+    or transition leaves its slot for the next one added. Only adding
+    or removing a node before the last one renumbers every node. '''
+
+    def __init__(self, graph):
+        self.graph = graph
+        # Slot of each State, and the unused node slots
+        self.slots = dict()
+        self.freeNodes = []
+        self.xs, self.ys = array('d'), array('d')
+        self.ends = array('b')
+        self.numbers = array('i')
+        # Slot of each (State, command), and the unused ones
+        self.edgeSlots = dict()
+        self.freeEdges = []
+        self.starts, self.targets = array('i'), array('i')
+        # The last snapshot taken, while the graph is unchanged
+        self.current = None
+        for state in graph.states:
+            self.addNode(state)
+        for state in graph.states:
+            for (cmd, end) in state.transitions.iteritems():
+                self.transitionAdded(state, cmd, end)
+        graph.addWatcher(self)
+
+    def detach(self):
+        ''' Stops following the graph '''
+        self.graph.removeWatcher(self)
+
+    def snapshot(self):
+        ''' Returns a Snapshot of the graph as it is now '''
+        if self.current is None:
+            self.current = Snapshot(self.xs[:], self.ys[:], self.ends[:],
+                                    self.numbers[:], self.starts[:],
+                                    self.targets[:])
+        return self.current
+
+    def addNode(self, state):
+        end = 1 if state.end else 0
+        if self.freeNodes:
+            slot = self.freeNodes.pop()
+            self.xs[slot], self.ys[slot] = state.x, state.y
+            self.ends[slot] = end
+            self.numbers[slot] = state.index
+        else:
+            slot = len(self.numbers)
+            self.xs.append(state.x)
+            self.ys.append(state.y)
+            self.ends.append(end)
+            self.numbers.append(state.index)
+        self.slots[state] = slot
+
+    def renumber(self):
+        numbers = self.numbers
+        for (state, slot) in self.slots.iteritems():
+            numbers[slot] = state.index
+
+    # ----------------------------------
+    # Following changes to the graph
+    # ----------------------------------
+
+    def stateAdded(self, state):
+        self.current = None
+        self.addNode(state)
+        if state.index != self.graph.numStates() - 1:
+            self.renumber()
+
+    def stateRemoved(self, state):
+        self.current = None
+        slot = self.slots.pop(state)
+        self.numbers[slot] = -1
+        self.freeNodes.append(slot)
+        self.renumber()
+
+    def transitionAdded(self, start, command, end):
+        self.current = None
+        if self.freeEdges:
+            k = self.freeEdges.pop()
+            self.starts[k] = self.slots[start]
+            self.targets[k] = self.slots[end]
+        else:
+            k = len(self.starts)
+            self.starts.append(self.slots[start])
+            self.targets.append(self.slots[end])
+        self.edgeSlots[(start, command)] = k
+
+    def transitionRemoved(self, start, command, end):
+        self.current = None
+        k = self.edgeSlots.pop((start, command))
+        self.starts[k] = -1
+        self.freeEdges.append(k)
+
+    def endChanged(self, state):
+        self.current = None
+        self.ends[self.slots[state]] = 1 if state.end else 0
+
+    def stateMoved(self, state, oldPosition):
+        self.current = None
+        slot = self.slots[state]
+        self.xs[slot], self.ys[slot] = state.x, state.y
+
+
+class Rasterizer:
+    ''' Draws Snapshots of graphs into image surfaces on a worker
+    thread. Only the latest request is kept: one made while another is
+    waiting replaces it. When a drawing is done, done is called on the
+    worker thread with the tag of the request and the surface. '''
+
+    def __init__(self, renderer, done):
+        self.renderer = renderer.copy()
+        self.done = done
+        self.pending = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, snapshot, width, height, tag, view=(1.0, 0, 0)):
+        ''' Asks for a snapshot to be drawn on a surface of the given
+        size. view is the (scale, x, y) of the zoom and the point of the
+        graph to put at the top left. '''
+        with self.condition:
+            self.pending = (snapshot, width, height, tag, view)
+            self.condition.notify()
+
+    def stop(self):
+        ''' Stops the worker thread once it finishes any drawing '''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                snapshot, width, height, tag, view = self.pending
+                self.pending = None
+            scale, x, y = view
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+            cr = cairo.Context(surface)
+            cr.scale(scale, scale)
+            cr.translate(-x, -y)
+            # Only what is in view
+            box = (x, y, x + width / scale, y + height / scale)
+            self.renderer.draw_snapshot(cr, snapshot, scale, box)
+            self.done(tag, surface)
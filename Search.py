@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import re
+from bisect import bisect_left, insort
+from collections import Counter
+
+from Model import *
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+def splitWords(text):
+    ''' Returns the lowercase words of a text '''
+    return WORD.findall(text.lower())
+
+class WordIndex:
+    ''' Finds the keys whose text has a word starting with or
+    containing a search term.
+
+    Each word maps to the keys using it (with a count of how many times
+    each does). The words are also kept sorted (once the first search
+    needs them), so words starting with a term are found by bisection,
+    and indexed by their three-letter parts, so words containing a
+    longer term are found by intersecting the sets of words sharing
+    its parts. '''
+
+    def __init__(self):
+        # For each word, a dict from key to the number of uses
+        self.words = dict()
+        # Sorted words, or None until the first search by word start
+        self.sorted = None
+        # For each three-letter part, the set of words containing it
+        self.trigrams = dict()
+
+    def add(self, key, text):
+        for word in splitWords(text):
+            self.addWord(key, word)
+
+    def remove(self, key, text):
+        for word in splitWords(text):
+            self.removeWord(key, word)
+
+    def change(self, key, oldText, newText):
+        ''' Updates the words of a key whose text changed, touching
+        only the words added or removed '''
+        old = Counter(splitWords(oldText))
+        new = Counter(splitWords(newText))
+        for (word, count) in (old - new).iteritems():
+            self.removeWord(key, word, count)
+        for (word, count) in (new - old).iteritems():
+            self.addWord(key, word, count)
+
+    def addWord(self, key, word, count=1):
+        keys = self.words.get(word)
+        if keys is None:
+            keys = self.words[word] = dict()
+            if self.sorted is not None:
+                insort(self.sorted, word)
+            for part in self.parts(word):
+                self.trigrams.setdefault(part, set()).add(word)
+        keys[key] = keys.get(key, 0) + count
+
+    def removeWord(self, key, word, count=1):
+        keys = self.words[word]
+        keys[key] -= count
+        if keys[key]:
+            return
+        del keys[key]
+        if keys:
+            return
+        # No key uses the word any more
+        del self.words[word]
+        if self.sorted is not None:
+            del self.sorted[bisect_left(self.sorted, word)]
+        for part in self.parts(word):
+            words = self.trigrams[part]
+            words.discard(word)
+            if not words:
+                del self.trigrams[part]
+
+    def parts(self, word):
+        return set(word[i:i+3] for i in xrange(len(word) - 2))
+
+    def startingWith(self, prefix):
+        ''' Returns the words starting with prefix '''
+        if self.sorted is None:
+            self.sorted = sorted(self.words)
+        words = self.sorted
+        i = bisect_left(words, prefix)
+        found = []
+        while i < len(words) and words[i].startswith(prefix):
+            found.append(words[i])
+            i += 1
+        return found
+
+    def containing(self, term):
+        ''' Returns the words containing term '''
+        if len(term) < 3:
+            # Too short to have parts; only look at word starts
+            return self.startingWith(term)
+        sets = [self.trigrams.get(part, ()) for part in self.parts(term)]
+        sets.sort(key=len)
+        return [word for word in sets[0]
+                if term in word and all(word in s for s in sets[1:])]
+
+    def find(self, term):
+        ''' Returns the set of keys with a word containing term '''
+        found = set()
+        for word in self.containing(term.lower()):
+            found.update(self.words[word])
+        return found
+
+
+class SearchIndex(GraphWatcher):
+    ''' Keeps word indexes of the text of the states of a graph and of
+    the commands of their transitions, following its edits. States are
+    found by the words of either. Also finds the transitions using a
+    command. '''
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.texts = WordIndex()
+        self.commands = WordIndex()
+        # For each command, the set of states with a transition on it
+        self.uses = dict()
+        for state in graph.states:
+            self.stateAdded(state)
+            for (cmd, end) in state.transitions.iteritems():
+                self.transitionAdded(state, cmd, end)
+        graph.addWatcher(self)
+
+    def detach(self):
+        ''' Stops following the graph '''
+        self.graph.removeWatcher(self)
+
+    def find(self, query):
+        ''' Returns the states, in order, with every word of the query
+        in a word of their text or of one of their commands '''
+        found = None
+        for term in splitWords(query):
+            states = self.texts.find(term) | self.commands.find(term)
+            found = states if found is None else found & states
+            if not found:
+                return []
+        return sorted(found or (), key=lambda st: st.index)
+
+    def commandUses(self, command):
+        ''' Returns the (start, end) states of the transitions on a
+        command, in order of their start '''
+        starts = sorted(self.uses.get(command, ()),
+                        key=lambda st: st.index)
+        return [(st, st.getTransition(command)) for st in starts]
+
+    def stateAdded(self, state):
+        self.texts.add(state, state.text)
+
+    def stateRemoved(self, state):
+        self.texts.remove(state, state.text)
+
+    def textChanged(self, state, oldText):
+        self.texts.change(state, oldText, state.text)
+
+    def transitionAdded(self, start, command, end):
+        self.commands.add(start, command)
+        self.uses.setdefault(command, set()).add(start)
+
+    def transitionRemoved(self, start, command, end):
+        self.commands.remove(start, command)
+        starts = self.uses[command]
+        starts.discard(start)
+        if not starts:
+            del self.uses[command]
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+''' Plays through a game many times without a GUI, to see how long
+games take, how often each ending is reached and which states are
+never visited.
+
+    $ ./Simulate.py samples/castle.game -n 1000000 --seed 1 --jobs 4
+'''
+
+import sys
+import random
+import argparse
+from array import array
+from multiprocessing import Pool
+
+try:
+    import numpy
+except ImportError:
+    # Walkers are then moved one at a time
+    numpy = None
+
+from Binary import *
+
+class Results:
+    ''' Statistics gathered from a set of playthroughs '''
+
+    def __init__(self, numStates):
+        # Number of playthroughs by number of moves taken
+        self.lengths = dict()
+        # Number of playthroughs by ending state reached
+        self.endings = dict()
+        # Playthroughs that got stuck or ran out of moves
+        self.unfinished = 0
+        # Flag for each state that was ever visited
+        self.visited = array('b', [0]) * numStates
+
+    def finished(self, state, moves, count=1):
+        ''' Records count playthroughs that reached an ending state '''
+        self.lengths[moves] = self.lengths.get(moves, 0) + count
+        self.endings[state] = self.endings.get(state, 0) + count
+
+    def merge(self, other):
+        ''' Adds the results of other into these results '''
+        for (moves, count) in other.lengths.iteritems():
+            self.lengths[moves] = self.lengths.get(moves, 0) + count
+        for (state, count) in other.endings.iteritems():
+            self.endings[state] = self.endings.get(state, 0) + count
+        self.unfinished += other.unfinished
+        for (i, v) in enumerate(other.visited):
+            if v: self.visited[i] = 1
+
+    def numPlays(self):
+        return sum(self.lengths.itervalues()) + self.unfinished
+
+    def unvisited(self):
+        ''' Returns a list of the states that were never visited '''
+        return [i for (i, v) in enumerate(self.visited) if not v]
+
+    def percentile(self, fraction):
+        ''' Returns the length of the finished playthrough at the
+        given fraction of the sorted lengths '''
+        total = sum(self.lengths.itervalues())
+        if not total:
+            return None
+        target = fraction * (total - 1)
+        seen = 0
+        for moves in sorted(self.lengths):
+            seen += self.lengths[moves]
+            if seen > target:
+                return moves
+
+    def __str__(self):
+        plays = self.numPlays()
+        lines = ['%d playthroughs' % plays]
+        if self.lengths:
+            total = sum(self.lengths.itervalues())
+            mean = sum(m * c for (m, c) in self.lengths.iteritems())
+            lines.append('Moves: min %d, median %d, 90%% %d, max %d, '
+                         'mean %.2f' % (
+                min(self.lengths), self.percentile(0.5),
+                self.percentile(0.9), max(self.lengths),
+                float(mean) / total))
+        for (state, count) in sorted(self.endings.iteritems()):
+            lines.append('Ended at #%d: %.2f%%' % (
+                state, 100.0 * count / plays))
+        if self.unfinished:
+            lines.append('Stuck or out of moves: %.2f%%' % (
+                100.0 * self.unfinished / plays))
+        unvisited = self.unvisited()
+        lines.append('%d states never visited' % len(unvisited))
+        if unvisited:
+            lines.append('  ' + ' '.join('#%d' % i for i in unvisited[:50]))
+        return '\n'.join(lines)
+
+
+def simulate(graph, numPlays, rng, maxMoves=1000, batchSize=10000):
+    ''' Runs numPlays random playthroughs of a CompactGraph from the
+    start state, picking each move with rng. A playthrough stops at
+    an ending state, at a state with no transitions, or after maxMoves
+    moves. Returns a Results.
+
+    With NumPy, each batch of walkers is moved with array operations
+    (drawing its random numbers from a generator seeded by rng);
+    without it, each walker is moved in turn. '''
+    results = Results(graph.numStates())
+    if numpy is not None:
+        table = TransitionTable(graph)
+        arrayRng = numpy.random.RandomState(rng.randrange(1 << 32))
+    while numPlays > 0:
+        size = min(batchSize, numPlays)
+        if numpy is not None:
+            runArrayBatch(table, size, arrayRng, maxMoves, results)
+        else:
+            runBatch(graph, size, rng, maxMoves, results)
+        numPlays -= size
+    if numpy is not None:
+        for i in numpy.flatnonzero(table.visited):
+            results.visited[i] = 1
+    return results
+
+def runBatch(graph, size, rng, maxMoves, results):
+    ''' Moves a batch of walkers through the graph, one move per walker
+    per step, until every walker has stopped. Each walker is moved by
+    its own pass of the loop: about a million moves a second, against
+    five million for runArrayBatch. '''
+    offsets, targets, ends = graph.offsets, graph.targets, graph.ends
+    visited = results.visited
+    rand = rng.random
+    visited[0] = 1
+    # Position of each walker still moving
+    walkers = array('i', [0]) * size
+    for moves in xrange(maxMoves + 1):
+        moving = array('i')
+        for i in walkers:
+            if ends[i]:
+                results.finished(i, moves)
+                continue
+            start = offsets[i]
+            degree = offsets[i + 1] - start
+            if not degree or moves == maxMoves:
+                results.unfinished += 1
+                continue
+            j = targets[start + int(rand() * degree)]
+            visited[j] = 1
+            moving.append(j)
+        walkers = moving
+        if not walkers:
+            break
+
+def numpyArray(values):
+    ''' Returns a NumPy view of an array or MappedArray '''
+    if isinstance(values, MappedArray):
+        return numpy.frombuffer(values.buf, values.item.format,
+                                len(values), values.offset)
+    return numpy.frombuffer(values, values.typecode)
+
+class TransitionTable:
+    ''' The arrays of a CompactGraph as NumPy arrays, for moving
+    batches of walkers with runArrayBatch '''
+
+    def __init__(self, graph):
+        self.offsets = numpyArray(graph.offsets).astype(numpy.intp)
+        self.targets = numpyArray(graph.targets).astype(numpy.intp)
+        self.ends = numpyArray(graph.ends).astype(bool)
+        self.degrees = numpy.diff(self.offsets)
+        # Flag for each state that was ever visited
+        self.visited = numpy.zeros(graph.numStates(), bool)
+        self.visited[0] = True
+
+def runArrayBatch(table, size, rng, maxMoves, results):
+    ''' Moves a batch of walkers through the graph together, taking a
+    step for all of them with each array operation, until every walker
+    has stopped. rng is a numpy.random.RandomState. '''
+    # Position of each walker still moving
+    walkers = numpy.zeros(size, numpy.intp)
+    for moves in xrange(maxMoves + 1):
+        done = table.ends[walkers]
+        if done.any():
+            states, counts = numpy.unique(walkers[done],
+                                          return_counts=True)
+            for (state, count) in zip(states.tolist(), counts.tolist()):
+                results.finished(state, moves, count)
+            walkers = walkers[~done]
+        degrees = table.degrees[walkers]
+        if moves == maxMoves:
+            results.unfinished += len(walkers)
+            break
+        stuck = degrees == 0
+        if stuck.any():
+            results.unfinished += int(stuck.sum())
+            walkers = walkers[~stuck]
+            degrees = degrees[~stuck]
+        if not len(walkers):
+            break
+        choices = (rng.random_sample(len(walkers)) * degrees).astype(
+            numpy.intp)
+        walkers = table.targets[table.offsets[walkers] + choices]
+        table.visited[walkers] = True
+
+def play(graph, commands, start=0):
+    ''' Follows a script of commands from the start state, returning
+    the list of states visited. Raises a ValueError if a command is
+    not available. '''
+    path = [start]
+    for command in commands:
+        state = graph.getTransition(path[-1], command)
+        if state is None:
+            raise ValueError('No command %r from state #%d' % (
+                command, path[-1]))
+        path.append(state)
+    return path
+
+# Graph loaded by each worker process
+workerGraph = None
+
+def startWorker(filename):
+    global workerGraph
+    workerGraph = loadGame(filename)
+
+def runWorker((numPlays, seed, maxMoves)):
+    return simulate(workerGraph, numPlays, random.Random(seed), maxMoves)
+
+def simulateFile(filename, numPlays, seed=None, maxMoves=1000, jobs=1):
+    ''' Runs playthroughs of a game file, splitting them over the given
+    number of processes. Returns a Results. '''
+    if seed is None:
+        seed = random.randrange(sys.maxint)
+    if jobs <= 1:
+        graph = loadGame(filename)
+        return simulate(graph, numPlays, random.Random(seed), maxMoves)
+    # Give each process its own share of the plays and its own seed
+    shares = [(numPlays // jobs + (1 if i < numPlays % jobs else 0),
+               seed * jobs + i, maxMoves) for i in xrange(jobs)]
+    pool = Pool(jobs, startWorker, (filename,))
+    try:
+        parts = pool.map(runWorker, shares)
+    finally:
+        pool.close()
+    results = parts[0]
+    for part in parts[1:]:
+        results.merge(part)
+    return results
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Plays through a game many times at random.')
+    parser.add_argument('game',
+                        help='.game or %s file to play' % EXTENSION)
+    parser.add_argument('-n', '--plays', type=int, default=10000,
+                        help='number of playthroughs')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the random choices')
+    parser.add_argument('--max-moves', type=int, default=1000,
+                        help='moves before giving up on a playthrough')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes to use')
+    options = parser.parse_args(args)
+    print simulateFile(options.game, options.plays, options.seed,
+                       options.max_moves, options.jobs)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
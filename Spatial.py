@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+from math import floor
+from heapq import heappush, heappop
+
+from Model import *
+from Geometry import *
+
+class SpatialIndex:
+    ''' Finds the items whose boxes overlap a rectangle.
+
+    Items are kept in a stack of grids whose cells double in size at
+    each level. An item goes in the first level with cells at least as
+    large as its box, in the cell holding the center of its box. It can
+    then only reach half a cell past that cell, so a query only needs
+    to look at the cells near the rectangle on each level. '''
+
+    def __init__(self, cellSize=64):
+        self.cellSize = cellSize
+        # For each level, a dict from (column, row) to a set of keys
+        self.levels = []
+        # For each key, its (level, cell, box)
+        self.where = dict()
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, key):
+        return key in self.where
+
+    def add(self, key, box):
+        ''' Adds (or moves) an item with a box (x0, y0, x1, y1) '''
+        if key in self.where:
+            self.remove(key)
+        x0, y0, x1, y1 = box
+        size = max(x1 - x0, y1 - y0)
+        level, cs = 0, self.cellSize
+        while cs < size:
+            level += 1
+            cs *= 2
+        while len(self.levels) <= level:
+            self.levels.append(dict())
+        cell = (int(floor((x0 + x1) / (2.0 * cs))),
+                int(floor((y0 + y1) / (2.0 * cs))))
+        self.levels[level].setdefault(cell, set()).add(key)
+        self.where[key] = (level, cell, box)
+
+    def remove(self, key):
+        ''' Removes an item '''
+        level, cell, _ = self.where.pop(key)
+        cells = self.levels[level]
+        cells[cell].discard(key)
+        if not cells[cell]:
+            del cells[cell]
+
+    def getBox(self, key):
+        return self.where[key][2]
+
+    def query(self, box):
+        ''' Returns a list of the keys of the items whose boxes overlap
+        box (x0, y0, x1, y1) '''
+        x0, y0, x1, y1 = box
+        where = self.where
+        found = []
+        cs = self.cellSize
+        for cells in self.levels:
+            half = cs / 2.0
+            c0 = int(floor((x0 - half) / cs))
+            c1 = int(floor((x1 + half) / cs))
+            r0 = int(floor((y0 - half) / cs))
+            r1 = int(floor((y1 + half) / cs))
+            if (c1 - c0 + 1) * (r1 - r0 + 1) > len(cells):
+                # Fewer cells are in use than the rectangle covers
+                groups = [keys for ((c, r), keys) in cells.iteritems()
+                          if c0 <= c <= c1 and r0 <= r <= r1]
+            else:
+                groups = [cells[(c, r)]
+                          for c in xrange(c0, c1 + 1)
+                          for r in xrange(r0, r1 + 1)
+                          if (c, r) in cells]
+            for keys in groups:
+                for key in keys:
+                    if overlaps(box, where[key][2]):
+                        found.append(key)
+            cs *= 2
+        return found
+
+
+class GraphIndex(GraphWatcher):
+    ''' Keeps spatial indexes of the nodes and transitions of a graph,
+    following its edits. Nodes are keyed by State, and transitions by
+    (State, command). '''
+
+    def __init__(self, graph, radius=RADIUS, arcSize=ARC_SIZE,
+                 arrowLength=ARROW_LENGTH):
+        self.graph = graph
+        self.radius = radius
+        self.arcSize = arcSize
+        self.arrowLength = arrowLength
+        self.nodes = SpatialIndex()
+        self.edges = SpatialIndex()
+        for state in graph.states:
+            self.stateAdded(state)
+            for cmd in state.transitions:
+                self.addEdge(state, cmd)
+        graph.addWatcher(self)
+
+    def nodeBox(self, state):
+        x, y = state.getPosition()
+        return node_bounds(x, y, self.radius)
+
+    def edgeBox(self, start, command):
+        end = start.transitions[command]
+        if end is start:
+            # Self-loops are drawn as part of the node
+            return self.nodeBox(start)
+        return edge_bounds(start.getPosition(), end.getPosition(),
+                           self.arcSize, self.arrowLength)
+
+    def addEdge(self, start, command):
+        self.edges.add((start, command), self.edgeBox(start, command))
+
+    def nodeAt(self, x, y):
+        ''' Returns the state under the point, or None. If nodes
+        overlap, the one with the lowest index is returned. '''
+        r = self.radius
+        near = self.nodes.query((x - r, y - r, x + r, y + r))
+        hits = [st for st in near if distance(x, y, st.x, st.y) <= r]
+        if not hits:
+            return None
+        return min(hits, key=lambda st: st.index)
+
+    def nodesIn(self, box):
+        ''' Returns the states whose drawing overlaps box, in order '''
+        found = self.nodes.query(box)
+        found.sort(key=lambda st: st.index)
+        return found
+
+    def edgesIn(self, box):
+        ''' Returns the (state, command) pairs for the transitions whose
+        drawing overlaps box '''
+        return self.edges.query(box)
+
+    # ----------------------------------
+    # Following changes to the graph
+    # ----------------------------------
+
+    def stateAdded(self, state):
+        self.nodes.add(state, self.nodeBox(state))
+
+    def stateRemoved(self, state):
+        self.nodes.remove(state)
+
+    def transitionAdded(self, start, command, end):
+        self.addEdge(start, command)
+
+    def transitionRemoved(self, start, command, end):
+        self.edges.remove((start, command))
+
+    def stateMoved(self, state, oldPosition):
+        self.nodes.add(state, self.nodeBox(state))
+        for cmd in state.transitions:
+            self.addEdge(state, cmd)
+        for (start, cmd) in state.incoming:
+            self.addEdge(start, cmd)
+
+
+class Extent(GraphWatcher):
+    ''' Keeps the largest x and y of the states of a graph, following
+    its edits.
+
+    For each axis, the number of states at each coordinate is counted,
+    and the coordinates are kept in a heap. Coordinates no state is at
+    any more are only dropped from the heap when they reach the top. '''
+
+    def __init__(self, graph):
+        self.graph = graph
+        # For each axis, a dict from coordinate to number of states
+        self.counts = (dict(), dict())
+        # For each axis, a heap of negated coordinates
+        self.heaps = ([], [])
+        for state in graph.states:
+            self.add(state.getPosition())
+        graph.addWatcher(self)
+
+    def detach(self):
+        ''' Stops following the graph '''
+        self.graph.removeWatcher(self)
+
+    def add(self, position):
+        for (value, counts, heap) in zip(position, self.counts, self.heaps):
+            count = counts.get(value, 0)
+            if not count:
+                heappush(heap, -value)
+            counts[value] = count + 1
+
+    def remove(self, position):
+        for (value, counts) in zip(position, self.counts):
+            counts[value] -= 1
+            if not counts[value]:
+                del counts[value]
+
+    def largest(self):
+        ''' Returns the largest (x, y) of the states, or 0 where that
+        is larger (positions are meant to be positive) '''
+        result = []
+        for (counts, heap) in zip(self.counts, self.heaps):
+            while heap and -heap[0] not in counts:
+                heappop(heap)
+            result.append(max(0, -heap[0]) if heap else 0)
+        return tuple(result)
+
+    def stateAdded(self, state):
+        self.add(state.getPosition())
+
+    def stateRemoved(self, state):
+        self.remove(state.getPosition())
+
+    def stateMoved(self, state, oldPosition):
+        self.remove(oldPosition)
+        self.add(state.getPosition())
+
+
+class DamageTracker(GraphWatcher):
+    ''' Collects the boxes of the drawing of a graph that its edits
+    affect, so that only those parts need to be redrawn. '''
+
+    def __init__(self, graph, radius=RADIUS, arcSize=ARC_SIZE,
+                 arrowLength=ARROW_LENGTH):
+        self.graph = graph
+        self.radius = radius
+        self.arcSize = arcSize
+        self.arrowLength = arrowLength
+        self.boxes = []
+        # Set when a change affects the whole drawing
+        self.everything = False
+        graph.addWatcher(self)
+
+    def detach(self):
+        ''' Stops following the graph '''
+        self.graph.removeWatcher(self)
+
+    def take(self):
+        ''' Returns the list of boxes affected since the last call, or
+        None if everything needs to be redrawn '''
+        boxes = None if self.everything else self.boxes
+        self.boxes = []
+        self.everything = False
+        return boxes
+
+    def addNode(self, (x, y)):
+        self.boxes.append(node_bounds(x, y, self.radius))
+
+    def addEdge(self, start, end, fromXY, toXY):
+        # Self-loops are drawn as part of the node
+        if start is not end:
+            self.boxes.append(edge_bounds(fromXY, toXY, self.arcSize,
+                                          self.arrowLength))
+
+    # ----------------------------------
+    # Following changes to the graph
+    # ----------------------------------
+
+    def stateAdded(self, state):
+        if state.index == self.graph.numStates() - 1:
+            self.addNode(state.getPosition())
+        else:
+            # The numbers shown on the following states change
+            self.everything = True
+
+    def stateRemoved(self, state):
+        # The numbers shown on the following states change
+        self.everything = True
+
+    def transitionAdded(self, start, command, end):
+        self.addEdge(start, end, start.getPosition(), end.getPosition())
+
+    def transitionRemoved(self, start, command, end):
+        self.addEdge(start, end, start.getPosition(), end.getPosition())
+
+    def endChanged(self, state):
+        self.addNode(state.getPosition())
+
+    def stateMoved(self, state, oldPosition):
+        position = state.getPosition()
+        self.addNode(oldPosition)
+        self.addNode(position)
+        for end in state.transitions.itervalues():
+            endXY = end.getPosition()
+            self.addEdge(state, end, oldPosition, endXY)
+            self.addEdge(state, end, position, endXY)
+        for (start, _) in state.incoming:
+            startXY = start.getPosition()
+            self.addEdge(start, state, startXY, oldPosition)
+            self.addEdge(start, state, startXY, position)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+''' Tests for the program. Those of the state pane need gtk, and are
+skipped without it.
+
+    $ ./Tests.py
+'''
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from Binary import *
+from Model import *
+from Spatial import *
+from Undo import *
+
+try:
+    from Controller import Controller
+    from View import StatePane
+except ImportError:
+    StatePane = None
+
+class UndoTarget:
+    ''' Stands in for the Controller whose selection Undo updates '''
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.selection = 0
+
+    def setStatePosition(self, state, position):
+        self.graph.moveState(state.index, *position)
+
+
+class AnalysisTest(unittest.TestCase):
+
+    def assertAnalysisCurrent(self, graph):
+        ''' Checks the kept analysis against searching from scratch '''
+        analysis = graph.analysis
+        self.assertEqual(set(analysis.getReachable()),
+                         set(graph.findReachable()))
+        self.assertEqual(set(analysis.getEscapable()),
+                         set(graph.findEscapable()))
+        reachable = set(graph.findReachable())
+        self.assertEqual(graph.getUnreachable(),
+                         [i for (i, st) in enumerate(graph.states)
+                          if st not in reachable])
+        self.assertEqual(graph.countUnreachable(),
+                         graph.numStates() - len(reachable))
+
+    def testRemoveStartState(self):
+        graph = Graph()
+        for text in 'abc':
+            graph.addState(text)
+        graph.addTransition(graph.getState(1), graph.getState(2), 'go')
+        graph.setEnd(2, True)
+        self.assertEqual(graph.getUnreachable(), [1, 2])
+        graph.removeState(0)
+        self.assertEqual(graph.getUnreachable(), [])
+        self.assertEqual(graph.countUnreachable(), 0)
+
+    def testRandomEdits(self):
+        for seed in xrange(20):
+            self.randomEdits(random.Random(seed), 300)
+
+    def randomEdits(self, rng, count):
+        ''' Makes random edits, some of them undone and redone, and
+        checks the analysis after each one '''
+        graph = Graph()
+        history = Undo(UndoTarget(graph), graph)
+        for i in xrange(8):
+            graph.addState(str(i))
+        for _ in xrange(count):
+            n = graph.numStates()
+            choice = rng.randrange(8)
+            if choice == 0:
+                graph.addState()
+                history.pushHistory((n, 'added'))
+            elif choice == 1 and n > 1:
+                # Any state, including the start state
+                history.pushHistory(graph.removeState(rng.randrange(n)))
+            elif choice == 2:
+                i = rng.randrange(n)
+                old = graph.setEnd(i, not graph.getState(i).end)
+                history.pushHistory((i, 'end', old))
+            elif choice == 3:
+                i = rng.randrange(n)
+                commands = graph.getState(i).transitions.keys()
+                if commands:
+                    history.pushHistory(graph.removeTransition(
+                        i, rng.choice(commands)))
+            elif choice == 4 and history.undo_stack:
+                # Undo some edits (re-inserting removed states), check,
+                # then redo them
+                steps = rng.randint(1, len(history.undo_stack))
+                for _ in xrange(steps):
+                    history.undo()
+                    self.assertAnalysisCurrent(graph)
+                for _ in xrange(steps):
+                    history.redo()
+                    self.assertAnalysisCurrent(graph)
+            else:
+                i = rng.randrange(n)
+                start = graph.getState(i)
+                command = 'c%d' % rng.randrange(3)
+                if command not in start.transitions:
+                    end = graph.getState(rng.randrange(n))
+                    graph.addTransition(start, end, command)
+                    history.pushHistory((i, 'addtr', command))
+            self.assertAnalysisCurrent(graph)
+
+
+class ExtentTest(unittest.TestCase):
+
+    def testRandomEdits(self):
+        rng = random.Random(0)
+        graph = Graph()
+        extent = Extent(graph)
+        for _ in xrange(2000):
+            n = graph.numStates()
+            choice = rng.randrange(3)
+            if choice == 0 or n < 2:
+                graph.addState('', rng.randrange(100), rng.randrange(100))
+            elif choice == 1:
+                graph.removeState(rng.randrange(n))
+            else:
+                graph.moveState(rng.randrange(n), rng.randrange(100),
+                                rng.randrange(100))
+            positions = [st.getPosition() for st in graph.states]
+            self.assertEqual(extent.largest(),
+                             (max(x for (x, y) in positions),
+                              max(y for (x, y) in positions)))
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testRoundTrip(self):
+        ''' Converts JSON to the binary format and back, and checks the
+        file written is the same text '''
+        graph = Graph()
+        for (i, (x, y)) in enumerate([(17, 4), (17.0, 2.5), (-3, 0.0)]):
+            graph.addState(u'state %d \u2192' % i, x, y)
+        graph.addTransition(graph.getState(0), graph.getState(1), 'go')
+        graph.addTransition(graph.getState(1), graph.getState(2), u'\xe9')
+        graph.setEnd(2, True)
+        source = os.path.join(self.dir, 'source.game')
+        binary = os.path.join(self.dir, 'graph' + EXTENSION)
+        dest = os.path.join(self.dir, 'dest.game')
+        saveGraph(graph, source)
+        saveBinary(loadGame(source), binary)
+        saveGraph(loadGame(binary), dest)
+        with open(source) as inf:
+            expected = inf.read()
+        with open(dest) as inf:
+            self.assertEqual(inf.read(), expected)
+
+
+@unittest.skipIf(StatePane is None, 'needs gtk')
+class StatePaneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = Controller()
+        for _ in xrange(4):
+            self.controller.createState(None)
+        self.controller.flushChanges()
+        self.pane = StatePane(self.controller)
+
+    def assertPaneCurrent(self):
+        ''' Checks the pane's state list against the graph '''
+        model = self.pane.stateModel
+        graph = self.controller.graph
+        self.assertEqual(len(model), graph.numStates())
+        self.assertEqual([tuple(row) for row in model],
+                         [self.pane.stateRow(i)
+                          for i in xrange(graph.numStates())])
+
+    def testRepeatedRemovals(self):
+        # Two removals at the same index before the updates are sent
+        for _ in xrange(2):
+            self.controller.selection = 2
+            self.controller.removeState(None)
+        self.controller.flushChanges()
+        self.assertPaneCurrent()
+
+    def testUndoRedo(self):
+        controller = self.controller
+        kinds = []
+        def listener(change):
+            kinds.append(change.kind)
+        controller.registerListener(listener, changes=True)
+        controller.selection = 2
+        controller.removeState(None)
+        controller.createTransition(None, ('go', 3))
+        controller.flushChanges()
+        for step in [controller.undo, controller.undo,
+                     controller.redo, controller.redo]:
+            step(None)
+            controller.flushChanges()
+            self.assertPaneCurrent()
+            state = controller.getCurrentState()
+            self.assertEqual([tuple(row) for row in self.pane.trModel],
+                             [self.pane.transitionRow(cmd, st)
+                              for (cmd, st) in state.listTransitions()])
+        # Each undo and redo was sent as the change it made
+        self.assertEqual(kinds[1:], ['rmtr', 'added', 'removed', 'addtr'])
+
+
+if __name__ == '__main__':
+    unittest.main()
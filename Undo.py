@@ -2,6 +2,53 @@
 
 from Model import *
 
+def textDiff(old, new):
+    ''' Returns (start, oldPart, newLen), describing the one part that
+    differs between two texts: in new, the newLen characters from start
+    took the place of oldPart in old '''
+    end = min(len(old), len(new))
+    start = 0
+    while start < end and old[start] == new[start]:
+        start += 1
+    # Common ending, not overlapping the common start
+    same = 0
+    while same < end - start and old[-1 - same] == new[-1 - same]:
+        same += 1
+    return (start, old[start:len(old) - same], len(new) - start - same)
+
+def applyTextDiff(text, (start, oldPart, newLen)):
+    ''' Undoes a textDiff on the new text, returning the old one '''
+    return text[:start] + oldPart + text[start + newLen:]
+
+class Change:
+    ''' Describes an update, for listeners registered to get changes.
+    kind is one of the strings below, index is the number of the state
+    it touched and command the command of the transition it touched.
+
+        'select'   the selection moved to index (from old)
+        'added'    state index was added
+        'removed'  state index was removed
+        'addtr'    transition command was added to state index
+        'rmtr'     transition command was removed from state index
+        'text'     the text of state index was edited
+        'end'      state index was made or unmade an ending state
+        'move'     state index was moved
+        'saved'    only the file state changed
+        'all'      anything may have changed (a new graph)
+
+    Undo and redo describe the change they make the same way, and may
+    also move the selection. '''
+
+    def __init__(self, kind, index=None, command=None, old=None):
+        self.kind = kind
+        self.index = index
+        self.command = command
+        self.old = old
+
+    def __repr__(self):
+        return 'Change(%r, %r, %r, %r)' % (self.kind, self.index,
+                                           self.command, self.old)
+
 class Undo:
     ''' Stores the undo history of the editing session '''
 
@@ -13,11 +60,14 @@ class Undo:
         # Storage for change history
         self.undo_stack = []
         self.redo_stack = []
+        # Whether the next text edit can be merged with the last one
+        self.coalescing = False
 
     def stateSaved(self):
         ''' Store the fact that the file was saved '''
         self.last_save = 0
         self.undo_stack = []
+        self.coalescing = False
 
     def unsavedChanges(self):
         ''' Returns True if there are unsaved changes '''
@@ -27,6 +77,24 @@ class Undo:
         ''' Store the data to reverse a change '''
         self.undo_stack.append(item)
         self.last_save += 1
+        self.coalescing = False
+
+    def pushTextEdit(self, num, old, new):
+        ''' Store the data to reverse an edit of the text of state num
+        from old to new. Edits made one after the other to the same
+        state are stored as one change. '''
+        top = self.undo_stack[-1] if self.undo_stack else None
+        if self.coalescing and top and top[:2] == (num, 'text'):
+            # Go back to the text before the last stored change
+            old = applyTextDiff(old, top[2:])
+            self.undo_stack[-1] = (num, 'text') + textDiff(old, new)
+        else:
+            self.pushHistory((num, 'text') + textDiff(old, new))
+            self.coalescing = True
+
+    def stopCoalescing(self):
+        ''' Makes the next text edit a change of its own '''
+        self.coalescing = False
 
     def pushRedo(self, item):
         ''' Store the data to redo a change after an undo '''
@@ -34,24 +102,31 @@ class Undo:
         
 
     def undo(self):
-        ''' Undo a change. '''
+        ''' Undo a change, returning the Change it made (or None if
+        there was nothing to undo) '''
+        self.coalescing = False
         if self.undo_stack:
             item = self.undo_stack.pop()
             self.last_save -= 1
-            rev = self.reverse_action(item)
+            rev, change = self.reverse_action(item)
             self.redo_stack.append(rev)
+            return change
 
     def redo(self):
-        ''' Redo a change. '''
+        ''' Redo a change, returning the Change it made (or None if
+        there was nothing to redo) '''
+        self.coalescing = False
         if self.redo_stack:
             item = self.redo_stack.pop()
             self.last_save += 1
-            rev = self.reverse_action(item)
+            rev, change = self.reverse_action(item)
             self.undo_stack.append(rev)
+            return change
 
     def reverse_action(self, item):
         ''' Reverse a previous action (whether undo or redo), and
-        returns the details to undo the change it makes''' 
+        returns the details to undo the change it makes and the Change
+        describing it ''' 
         num = item[0]
         kind = item[1]
         graph = self.graph
@@ -61,55 +136,59 @@ class Undo:
             history = graph.removeState(num)
             if self.controller.selection == num:
                 self.controller.selection -= 1
-            self.controller.recalcPositions()
-            return history
+            return history, Change('removed', num)
 
         # Undo a removal of a state
         if kind == 'removed':
             # Build state & insert it back into the list
             s = item[2]
             state = State(s['state'], None, s['x'], s['y'], s['end'])
-            graph.states.insert(num, state)
+            graph.insertState(num, state)
             # Add outgoing transitions
             for cmd, n in s['transitions'].iteritems():
-                state.addTransition(cmd, graph.getState(n))
+                graph.addTransition(state, graph.getState(n), cmd)
             # Add incoming transitions
             incoming = item[3]
             for n, cmd in incoming:
-                graph.getState(n).addTransition(cmd, state)
+                graph.addTransition(graph.getState(n), state, cmd)
             history = (num, 'added')
+            change = Change('added', num)
 
-        # Undo a change of state text
+        # Undo a change of state text (stored as a textDiff)
         elif kind == 'text':
-            state = graph.getState(num)
-            old = state.setText(item[2])
-            history = (num, 'text', old)
+            text = graph.getText(num)
+            old = applyTextDiff(text, item[2:])
+            graph.setText(num, old)
+            history = (num, 'text') + textDiff(text, old)
+            change = Change('text', num)
 
         # Undo an addition of a transition
         elif kind == 'addtr':
             command = item[2]
             history = graph.removeTransition(num, command)
+            change = Change('rmtr', num, command)
 
         # Undo a removal of a transition
         elif kind == 'rmtr':
             state = graph.getState(num)
             to = graph.getState(item[3])
             command = item[2]
-            state.addTransition(command, to)
+            graph.addTransition(state, to, command)
             history = (num, 'addtr', command)
+            change = Change('addtr', num, command)
 
         # Undo a toggle of the 'end' value
         elif kind == 'end':
-            state = graph.getState(num)
-            history = (num, 'end', state.end)
-            state.end = item[2]
+            old = graph.setEnd(num, item[2])
+            history = (num, 'end', old)
+            change = Change('end', num)
 
         # Undo a repositioning of a state
         elif kind == 'move':
             state = graph.getState(num)
             history = (num, 'move', state.getPosition())
-            x, y = item[2]
-            state.setPosition(x, y)
+            self.controller.setStatePosition(state, item[2])
+            change = Change('move', num)
 
         # The 'huh?' case
         else:
@@ -119,7 +198,7 @@ class Undo:
         # related state
         self.controller.selection = num
 
-        return history
+        return history, change
 
 
     def __str__(self):
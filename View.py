@@ -8,6 +8,7 @@ import gobject
 from Controller import *
 from Model import *
 from GraphArea import *
+from MiniMap import *
 
 def leftLabel(text):
     ''' Creates a left algined label (a typing-saver) '''
@@ -15,6 +16,17 @@ def leftLabel(text):
     label.set_alignment(0, 0.5)
     return label
 
+def firstLine(text):
+    ''' Returns the start of the first line of a text '''
+    line = text.split('\n', 1)[0]
+    if len(line) > 40:
+        line = line[:40] + '...'
+    return line
+
+def stateLabel(state):
+    ''' Names a state by its number and the start of its text '''
+    return '#%d %s' % (state.index, firstLine(state.text))
+
 def iconButton(stock_id, text=None):
     ''' Creates a button with the icon of the given stock id'''
     btn = gtk.Button()
@@ -162,39 +174,79 @@ class StatePane(gtk.VBox):
         gtk.VBox.__init__(self, False, 5)
         self.updating = False
         self.controller = controller
+        # The selection the pane shows
+        self.selection = None
         self.set_border_width(5)
         self.set_size_request(300, -1)
+        # One row per state, in order, shared by the state pickers:
+        # (first line of text, state). Rows do not hold the numbers of
+        # their states, so none change when a state is removed.
+        self.stateModel = gtk.ListStore(str, object)
         self.addStateSelection()
         self.addStateText()
         self.addTransitionAdd()
         self.addTransitionList()
         self.update()
-        controller.registerListener(self.update)
+        controller.registerListener(self.update, fileUpdates=True,
+                                    changes=True)
 
-    def update(self):
+    def update(self, change=None):
         if self.updating: 
             return
         self.updating = True
         # Get info
         graph = self.controller.graph
-        numStates = graph.numStates()
         currentState = self.controller.getCurrentState()
-        # Update the UI
-        self.updateStateCombo(numStates)
-        self.updateStateInfo(currentState)
-        self.updateTrCombo(numStates)
-        self.populateTransitions(currentState, graph)
+        kind = change.kind if change else 'all'
+        # Undo and redo can move the selection along with their change
+        moved = self.selection != self.controller.selection
+        self.selection = self.controller.selection
+        # Update only what the change touched
+        if kind == 'added':
+            self.stateModel.insert(change.index, self.stateRow(change.index))
+        elif kind == 'removed':
+            self.stateModel.remove(self.stateModel.get_iter(change.index))
+        elif kind == 'text':
+            self.stateModel[change.index] = self.stateRow(change.index)
+            # Only undo and redo change the text behind the text box
+            if self.getStateText() != currentState.text:
+                moved = True
+        elif kind == 'all':
+            self.fillStateModel(graph.numStates())
+        if moved or kind in ('added', 'removed', 'select', 'text', 'all'):
+            self.stateEntry.set_text(stateLabel(currentState))
+        if moved or kind in ('added', 'removed', 'select', 'end', 'all'):
+            self.updateStateInfo(currentState)
+        if moved or kind in ('added', 'removed', 'select', 'all'):
+            self.populateTransitions(currentState)
+        elif kind == 'addtr':
+            self.trModel.append(self.transitionRow(
+                change.command, currentState.getTransition(change.command)))
+        elif kind == 'rmtr':
+            self.removeTransitionRow(change.command)
         self.updating = False
 
-    def updateStateCombo(self, numStates):
-        # Clear existing contents
-        model = self.stateCombo.get_model()
+    def stateRow(self, index):
+        state = self.controller.graph.getState(index)
+        return (firstLine(state.text), state)
+
+    def fillStateModel(self, numStates):
+        model = self.stateModel
         model.clear()
-        # Set new contents
         for i in xrange(numStates):
-            s = '#' + str(i)
-            self.stateCombo.append_text(s)
-        self.stateCombo.set_active(self.controller.selection)
+            model.append(self.stateRow(i))
+
+    def getStateText(self):
+        buf = self.stateTextBuffer
+        return buf.get_text(buf.get_start_iter(), buf.get_end_iter())
+
+    def findState(self, text):
+        ''' Returns the number of the state a picker's text names
+        ('#12', '12' or a state label), or -1 if none '''
+        number = text.strip().lstrip('#').split(' ', 1)[0]
+        if not number.isdigit() or int(number) >= len(self.stateModel):
+            return -1
+        return int(number)
 
     def updateStateInfo(self, state):
         isStart = self.controller.selection == 0
@@ -208,33 +260,40 @@ class StatePane(gtk.VBox):
         self.checkEndState.set_active(active)
         self.checkEndState.set_sensitive(not isStart)
 
-    def updateTrCombo(self, numStates):
-        # Clear & re-fill the transition combo box
-        self.trCombo.get_model().clear()
-        for i in xrange(numStates):
-            self.trCombo.append_text('#' + str(i))
-            
-    def populateTransitions(self, state, graph):
-        for child in self.trList.get_children():
-            self.trList.remove(child)
+    def transitionRow(self, command, state):
+        index = self.controller.graph.getIndex(state)
+        return (command, '#' + str(index), index)
+
+    def populateTransitions(self, state):
+        self.trModel.clear()
         for (cmd, st) in state.listTransitions():
-            hb = gtk.HBox()
-            text = cmd + ' to #' + str(graph.getIndex(st))
-            hb.pack_start(leftLabel(text), False, False, 5)
-            btn = iconButton(gtk.STOCK_REMOVE)
-            btn.connect('clicked', self.controller.removeTransition, cmd)
-            hb.pack_start(btn, False, False, 5)
-            self.trList.pack_start(hb, False, False)
-            hb.show_all()
+            self.trModel.append(self.transitionRow(cmd, st))
+
+    def removeTransitionRow(self, command):
+        model = self.trModel
+        for i in xrange(len(model)):
+            if model[i][0] == command:
+                model.remove(model.get_iter(i))
+                return
+
+    def addStatePicker(self):
+        ''' Creates an entry for choosing a state, completing what is
+        typed from the start of the state texts (or taking a state
+        number) '''
+        completion = gtk.EntryCompletion()
+        completion.set_model(self.stateModel)
+        completion.set_text_column(0)
+        completion.set_minimum_key_length(1)
+        entry = gtk.Entry()
+        entry.set_completion(completion)
+        return entry
 
     def addStateSelection(self):
         # Create elements
-        self.stateCombo = gtk.ComboBox(gtk.ListStore(str))
-        cell = gtk.CellRendererText()
-        self.stateCombo.pack_start(cell, True)
-        self.stateCombo.add_attribute(cell, 'text', 0)
-        self.stateCombo.connect(
-            'changed', self.controller.selectStateListener)
+        self.stateEntry = self.addStatePicker()
+        self.stateEntry.connect('activate', self.cb_pick_state)
+        self.stateEntry.get_completion().connect(
+            'match-selected', self.cb_state_selected)
         self.addBtn = iconButton(gtk.STOCK_ADD, text='Create new state')
         self.addBtn.connect('clicked', self.controller.createState)
         self.rmBtn = iconButton(gtk.STOCK_REMOVE, text='Remove')
@@ -246,7 +305,7 @@ class StatePane(gtk.VBox):
         self.pack_start(hb2, False)
         hb = gtk.HBox(False, 0)
         hb.pack_start(leftLabel('State:'), False, False, 5)
-        hb.pack_start(self.stateCombo, False, False, 5)
+        hb.pack_start(self.stateEntry, True, True, 5)
         hb.pack_end(self.rmBtn, False, False, 5)
         self.pack_start(hb, False)
         self.pack_start(gtk.HSeparator(), False)
@@ -279,23 +338,20 @@ class StatePane(gtk.VBox):
         self.pack_start(gtk.HSeparator(), False)
 
     def addTransitionAdd(self):
-        # Set up combo box
-        combo = gtk.ComboBox(gtk.ListStore(str))
-        combo.connect('changed', self.cb_update_trcombo)
-        cell = gtk.CellRendererText()
-        combo.pack_start(cell, True)
-        combo.add_attribute(cell, 'text', 0)
-        
         # Make layout
         vb = gtk.VBox(False, 0)
         vb.pack_start(leftLabel('Add a transition:'))
         entry = gtk.Entry(max = 100)
-        entry.connect('changed', self.cb_update_trentry)
+        entry.connect('changed', self.cb_update_tradd)
         vb.pack_start(entry)
 
         hb = gtk.HBox(False, 0)
         hb.pack_start(leftLabel('to'), False, False, 5)
-        hb.pack_start(combo, False, False, 5)
+        target = self.addStatePicker()
+        target.connect('changed', self.cb_update_tradd)
+        target.get_completion().connect('match-selected',
+                                        self.cb_target_selected)
+        hb.pack_start(target, True, True, 5)
         btn = gtk.Button('add')
         btn.set_sensitive(False)
         btn.connect('clicked', self.cb_add_transition)
@@ -303,47 +359,137 @@ class StatePane(gtk.VBox):
 
         vb.pack_start(hb)
         self.trEntry = entry
-        self.trCombo = combo
+        self.trTarget = target
         self.trAdd = btn
         self.pack_start(vb, False, False)
 
     def addTransitionList(self):
         self.pack_start(gtk.HSeparator(), False)
         self.pack_start(leftLabel('Transitions:'), False)
+        # List of transitions: (command, target label, target number)
+        self.trModel = gtk.ListStore(str, str, int)
+        view = gtk.TreeView(self.trModel)
+        for (column, title) in enumerate(('Command', 'To')):
+            cell = gtk.CellRendererText()
+            view.append_column(gtk.TreeViewColumn(title, cell,
+                                                  text=column))
+        view.connect('row-activated', self.cb_goto_target)
+        view.get_selection().connect('changed', self.cb_update_trremove)
         # Scrolled Window
         scroll = gtk.ScrolledWindow()
         scroll.set_policy(gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC)
-        # List of transitions
-        vb = gtk.VBox(False, 0)
-        scroll.add_with_viewport(vb)
-        self.trList = vb
+        scroll.add(view)
+        btn = iconButton(gtk.STOCK_REMOVE, text='Remove')
+        btn.set_sensitive(False)
+        btn.connect('clicked', self.cb_remove_transition)
+        hb = gtk.HBox(False, 0)
+        hb.pack_end(btn, False, False, 5)
+        self.trList = view
+        self.trRemove = btn
         self.pack_start(scroll)
+        self.pack_start(hb, False)
 
-    def setTransitionItems(self, items):
-        ''' Creates an element in the list of 
-        transitions '''
-        self.trList.clear()
-        for (n, s) in items:
-            row = (n, s, gtk.Button('-'))
-            self.trList.append(row)                
+    def cb_pick_state(self, widget):
+        self.controller.selectState(self.findState(widget.get_text()))
+
+    def cb_state_selected(self, completion, model, iter):
+        self.controller.selectState(model[iter][1].index)
+        return True
+
+    def cb_target_selected(self, completion, model, iter):
+        self.trTarget.set_text(stateLabel(model[iter][1]))
+        return True
 
     def cb_add_transition(self, widget):
         command = self.trEntry.get_text()
-        endNo = self.trCombo.get_active()
+        endNo = self.findState(self.trTarget.get_text())
         if self.controller.createTransition(widget, (command, endNo)):
             self.trEntry.set_text('')
 
-    def cb_update_trentry(self, widget, data=None):
+    def cb_update_tradd(self, widget, data=None):
         # Selectively enable the 'add' button
         addEnabled = bool(self.trEntry.get_text())
-        addEnabled &= self.trCombo.get_active() > -1
+        addEnabled &= self.findState(self.trTarget.get_text()) > -1
         self.trAdd.set_sensitive(addEnabled)
 
-    def cb_update_trcombo(self, widget, data=None):
-        # Selectively enable the 'add' button
-        addEnabled = self.trCombo.get_active() > -1
-        addEnabled &= bool(self.trEntry.get_text())
-        self.trAdd.set_sensitive(addEnabled)
+    def cb_update_trremove(self, selection):
+        model, iter = selection.get_selected()
+        self.trRemove.set_sensitive(iter is not None)
+
+    def cb_remove_transition(self, widget):
+        model, iter = self.trList.get_selection().get_selected()
+        if iter is not None:
+            self.controller.removeTransition(widget, model[iter][0])
+
+    def cb_goto_target(self, view, path, column):
+        self.controller.selectState(self.trModel[path][2])
+
+
+class FindPane(gtk.VBox):
+    ''' Finds states by the words of their text and commands, or the
+    transitions using a command '''
+
+    def __init__(self, controller, maxResults=100):
+        gtk.VBox.__init__(self, False, 5)
+        self.controller = controller
+        self.maxResults = maxResults
+        self.set_border_width(5)
+        # Search box
+        self.findEntry = gtk.Entry()
+        self.findEntry.connect('changed', self.cb_find)
+        self.usesCheck = gtk.CheckButton('Where is this command used')
+        self.usesCheck.connect('toggled', self.cb_find)
+        # Results: (label, state number)
+        self.results = gtk.ListStore(str, int)
+        view = gtk.TreeView(self.results)
+        view.set_headers_visible(False)
+        view.append_column(gtk.TreeViewColumn('', gtk.CellRendererText(),
+                                              text=0))
+        view.connect('row-activated', self.cb_goto_result)
+        scroll = gtk.ScrolledWindow()
+        scroll.set_policy(gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC)
+        scroll.set_size_request(-1, 120)
+        scroll.add(view)
+        # Make layout
+        hb = gtk.HBox(False, 0)
+        hb.pack_start(leftLabel('Find:'), False, False, 5)
+        hb.pack_start(self.findEntry, True, True, 5)
+        self.pack_start(hb, False)
+        self.pack_start(self.usesCheck, False)
+        self.pack_start(scroll)
+        self.pack_start(gtk.HSeparator(), False)
+        controller.registerListener(self.update, fileUpdates=True,
+                                    changes=True)
+
+    def update(self, change=None):
+        kind = change.kind if change else 'all'
+        # Selecting or moving states does not change what is found
+        if kind not in ('select', 'move', 'saved', 'end'):
+            self.showResults()
+
+    def showResults(self):
+        ''' Fills the result list for the text in the search box '''
+        self.results.clear()
+        query = self.findEntry.get_text()
+        search = self.controller.search
+        if self.usesCheck.get_active():
+            found = [('%s to #%d' % (stateLabel(start), end.index),
+                      start.index)
+                     for (start, end) in search.commandUses(query.strip())]
+        else:
+            found = [(stateLabel(st), st.index)
+                     for st in search.find(query)]
+        for row in found[:self.maxResults]:
+            self.results.append(row)
+        if len(found) > self.maxResults:
+            self.results.append(('(%d more)' % (len(found) -
+                                                self.maxResults), -1))
+
+    def cb_find(self, widget):
+        self.showResults()
+
+    def cb_goto_result(self, view, path, column):
+        self.controller.selectState(self.results[path][1])
 
 
 class BuilderWindow:
@@ -356,6 +502,7 @@ class BuilderWindow:
         self.setContent()
         addKbdShortcuts(self.window, controller)
         self.window.show_all()
+        self.progressBar.hide()
 
     def setupWindow(self):
         w = gtk.Window(gtk.WINDOW_TOPLEVEL)
@@ -375,10 +522,20 @@ class BuilderWindow:
         self.graphPane = GraphArea(self.controller)
         hb.pack_start(self.graphPane)
         # Right side
+        right = gtk.VBox(False, 0)
+        self.miniMap = MiniMap(self.controller, self.graphPane)
+        right.pack_start(self.miniMap, False)
+        self.findPane = FindPane(self.controller)
+        right.pack_start(self.findPane, False)
         self.statePane = StatePane(self.controller)
-        hb.pack_start(self.statePane, False)
+        right.pack_start(self.statePane)
+        hb.pack_start(right, False)
+        # Progress of loading a file (shown only while loading)
+        self.progressBar = gtk.ProgressBar()
+        self.progressShown = None
         # Setup
         vb.pack_start(hb, True, True)
+        vb.pack_start(self.progressBar, False, False)
         self.window.add(vb)
         self.vb = vb
         self.setTitle()
@@ -392,6 +549,24 @@ class BuilderWindow:
             title = '*' + title
         self.window.set_title(title)
 
+    def showProgress(self, done, total):
+        ''' Shows how much of a file has been loaded, and lets gtk
+        redraw the window. Called for every state loaded, so the bar
+        only changes when another percent is done. '''
+        percent = 100 * done // total if total else 100
+        if percent == self.progressShown:
+            return
+        self.progressShown = percent
+        self.progressBar.set_fraction(percent / 100.0)
+        self.progressBar.set_text('Loading... %d%%' % percent)
+        self.progressBar.show()
+        while gtk.events_pending():
+            gtk.main_iteration(False)
+
+    def hideProgress(self):
+        self.progressBar.hide()
+        self.progressShown = None
+
     def update(self):
         ''' Updates the window in response to an update in the
         controller'''